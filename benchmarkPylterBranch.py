@@ -0,0 +1,239 @@
+# Micro-benchmarks for the pylter_branch data structures, on synthetic data.
+# Usage: python3 benchmarkPylterBranch.py [benchmarkName ...]
+
+import sys
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import tracemalloc
+from collections import defaultdict
+
+import pygit2
+
+from pylter_branch import TopoSort
+from pylter_branch.TreeProcessor import TreeWrapper, FileEntry
+from pylter_branch.OidTable import OidSet, OidMap
+
+
+def fakeOid(number):
+    return pygit2.Oid(raw=hashlib.sha1(str(number).encode("ascii")).digest())
+
+
+def measure(label, callback):
+    # Timed and traced in separate runs, tracing allocations slows everything down
+    startTime = time.perf_counter()
+    result = callback()
+    elapsedTime = time.perf_counter() - startTime
+
+    tracemalloc.start()
+    tracedResult = callback()
+    retainedMemory, peakMemory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tracedResult
+
+    print("  {0: <40} {1: >9.3f}s {2: >9.1f} MB retained {3: >9.1f} MB peak".format(
+        label, elapsedTime, retainedMemory / 2**20, peakMemory / 2**20)
+    )
+    return result
+
+
+class LegacyTopoSort:
+    """The set-of-Oids, list-queue implementation TopoSort replaced"""
+    def __init__(self):
+        self.vertices = set()
+        self.edges = defaultdict(set)
+
+    def add_edge(self, source, destination):
+        self.add_vertex(source)
+        self.add_vertex(destination)
+        self.edges[source].add(destination)
+
+    def add_vertex(self, vertex):
+        self.vertices.add(vertex)
+
+    def sort(self):
+        ingrees = { v : 0 for v in self.vertices }
+        for neighbours in self.edges.values():
+            for u in neighbours:
+                ingrees[u] += 1
+
+        non_processed = self.vertices.copy()
+        queue = [ v for v, ingree in ingrees.items() if ingree == 0 ]
+        topo_order = []
+
+        while queue:
+            u = queue.pop(0)
+            topo_order.append(u)
+            for v in self.edges[u]:
+                ingrees[v] -= 1
+                if ingrees[v] == 0:
+                    queue.append(v)
+            non_processed.remove(u)
+
+        if len(non_processed):
+            raise RuntimeError("Cycles are in graph")
+
+        return topo_order
+
+
+def syntheticHistory(commitCount, seed = 42):
+    """Mostly linear history with a merge from a recent commit every 10 commits, as (commit, parents) pairs"""
+    random.seed(seed)
+    oids = [fakeOid(number) for number in range(commitCount)]
+    history = []
+    for number in range(commitCount):
+        parents = [oids[number - 1]] if number else []
+        if number > 20 and number % 10 == 0:
+            parents.append(oids[number - random.randint(2, 20)])
+        history.append((oids[number], parents))
+    return history
+
+
+def fillSorter(sorter, history):
+    for commitId, parents in history:
+        for parent in parents:
+            sorter.add_edge(commitId, parent)
+        sorter.add_vertex(commitId)
+    return sorter.sort()
+
+
+def benchmarkTopoSort(commitCounts = (100000, 1000000)):
+    for commitCount in commitCounts:
+        print("TopoSort, {0} commits".format(commitCount))
+        history = syntheticHistory(commitCount)
+        measure("LegacyTopoSort", lambda: fillSorter(LegacyTopoSort(), history))
+        measure("TopoSort", lambda: fillSorter(TopoSort.TopoSort(), history))
+
+
+def fillSet(container, oids):
+    for oid in oids:
+        container.add(oid)
+    return container
+
+def fillMap(container, oids):
+    # Like replaced_commits: original -> rewritten, and rewritten -> itself
+    for number in range(0, len(oids), 2):
+        container[oids[number]] = oids[number + 1]
+        container[oids[number + 1]] = oids[number + 1]
+    return container
+
+def lookUpAll(container, oids):
+    return sum(1 for oid in oids if oid in container)
+
+
+def benchmarkOidTables(entryCount = 1000000):
+    print("Known objects / replaced commits, {0} entries".format(entryCount))
+    # Oids are created inside the measured callbacks: holding them is part of the cost of the Python containers
+    measure("set of Oid", lambda: fillSet(set(), (fakeOid(number) for number in range(entryCount))))
+    measure("OidSet", lambda: fillSet(OidSet(), (fakeOid(number) for number in range(entryCount))))
+    measure("dict of Oid -> Oid", lambda: fillMap({}, [fakeOid(number) for number in range(entryCount)]))
+    measure("OidMap", lambda: fillMap(OidMap(), [fakeOid(number) for number in range(entryCount)]))
+
+    oids = [fakeOid(number) for number in range(entryCount)]
+    oidSet = fillSet(OidSet(), oids)
+    pythonSet = set(oids)
+    measure("lookups, set of Oid", lambda: lookUpAll(pythonSet, oids))
+    measure("lookups, OidSet", lambda: lookUpAll(oidSet, oids))
+
+
+def syntheticTree(repo, directoryCount, filesPerDirectory, version):
+    """Tree with src/dirN/fileM.js files, each blob tagged with version, plus the (path, entry) pairs of the files"""
+    files = []
+    srcBuilder = repo.TreeBuilder()
+    for directoryNumber in range(directoryCount):
+        builder = repo.TreeBuilder()
+        for fileNumber in range(filesPerDirectory):
+            name = "file{0}.js".format(fileNumber)
+            blobId = repo.create_blob("{0} {1} {2}".format(version, directoryNumber, fileNumber).encode("ascii"))
+            builder.insert(name, blobId, pygit2.GIT_FILEMODE_BLOB)
+            path = "src/dir{0}/{1}".format(directoryNumber, name)
+            files.append((path, FileEntry(blobId.hex, pygit2.GIT_FILEMODE_BLOB)))
+        srcBuilder.insert("dir{0}".format(directoryNumber), builder.write(), pygit2.GIT_FILEMODE_TREE)
+
+    rootBuilder = repo.TreeBuilder()
+    rootBuilder.insert("src", srcBuilder.write(), pygit2.GIT_FILEMODE_TREE)
+    return repo[rootBuilder.write()], files
+
+def insertPerPath(repo, tree, files):
+    wrapper = TreeWrapper(repo, tree)
+    for path, entry in files:
+        wrapper.insert(path, entry)
+    return wrapper.hex()
+
+def insertBatch(repo, tree, files, wrapperClass = TreeWrapper):
+    wrapper = wrapperClass(repo, tree)
+    wrapper.apply([("insert", path, entry) for path, entry in files])
+    return wrapper.hex()
+
+
+def benchmarkTreeEdits(layouts = ((1, 3000), (100, 300))):
+    repoPath = tempfile.mkdtemp(prefix="benchmark-tree-edits-")
+    try:
+        repo = pygit2.init_repository(repoPath, bare=True)
+        for directoryCount, filesPerDirectory in layouts:
+            print("Mass reformat, {0} directories x {1} files".format(directoryCount, filesPerDirectory))
+            tree, _ = syntheticTree(repo, directoryCount, filesPerDirectory, "original")
+            reformattedTree, reformattedFiles = syntheticTree(repo, directoryCount, filesPerDirectory, "reformatted")
+
+            perPathHex = measure("insert per path", lambda: insertPerPath(repo, tree, reformattedFiles))
+            batchHex = measure("apply", lambda: insertBatch(repo, tree, reformattedFiles))
+            assert perPathHex == batchHex == reformattedTree.hex
+    finally:
+        shutil.rmtree(repoPath)
+
+
+class UnslottedTreeWrapper(TreeWrapper):
+    """
+    TreeWrapper nodes laid out as before __slots__: the class attributes shadow the slots, so the attributes live in
+    an instance __dict__, and both edit dicts are created up front
+    """
+    _repository = _tree = _children = _changes = None
+
+    def __init__(self, repository, tree):
+        super().__init__(repository, tree)
+        self._children = {}
+        self._changes = {}
+
+def readAll(repo, tree, files, wrapperClass = TreeWrapper):
+    wrapper = wrapperClass(repo, tree)
+    for path, _ in files:
+        wrapper.get(path)
+    return wrapper
+
+def benchmarkTreeMemory(layouts = ((400, 500), (20000, 5))):
+    # Only Python allocations are traced: pygit2 trees and libgit2 caches are not part of the figures.
+    # "read every file" keeps the wrapped tree, one node per directory, so its retained memory is the cost of the nodes
+    repoPath = tempfile.mkdtemp(prefix="benchmark-tree-memory-")
+    try:
+        repo = pygit2.init_repository(repoPath, bare=True)
+        for directoryCount, filesPerDirectory in layouts:
+            print("Working tree, {0} directories x {1} files".format(directoryCount, filesPerDirectory))
+            tree, _ = syntheticTree(repo, directoryCount, filesPerDirectory, "original")
+            _, reformattedFiles = syntheticTree(repo, directoryCount, filesPerDirectory, "reformatted")
+            someFiles = reformattedFiles[::200]
+
+            for wrapperClass in (UnslottedTreeWrapper, TreeWrapper):
+                name = wrapperClass.__name__
+                measure(name + ", read every file", lambda: readAll(repo, tree, reformattedFiles, wrapperClass))
+                measure(name + ", rewrite {0} files".format(len(someFiles)),
+                        lambda: insertBatch(repo, tree, someFiles, wrapperClass))
+    finally:
+        shutil.rmtree(repoPath)
+
+
+BENCHMARKS = {
+    "toposort" : benchmarkTopoSort,
+    "oidtables" : benchmarkOidTables,
+    "treeedits" : benchmarkTreeEdits,
+    "treememory" : benchmarkTreeMemory,
+}
+
+
+def main(benchmarkNames):
+    for benchmarkName in benchmarkNames or BENCHMARKS.keys():
+        BENCHMARKS[benchmarkName]()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
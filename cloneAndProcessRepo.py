@@ -1,56 +1,161 @@
 from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import os, sys
 import shutil, tempfile
 import time, datetime as dt
 
 import pygit2
 from pygit2 import IndexEntry
+import requests
 
 from pylter_branch import RepositoryProcessor, TreeProcessor
+from pylter_branch.CommitJournal import CommitJournal
+from pylter_branch.OidTable import OidSet
+from pylter_branch.TreeProcessor import FileEntry
 
 from repoFilterUtils import *
 
-from transformJSFiles import rewriteAvailableJSFiles
-from transformPYFiles import formatPYFiles
+from transformJSFiles import rewriteAvailableJSFiles, jsPathClasses, jsTransformerFingerprint, isSkippedFile, \
+    isFirstMatchDependent, AsyncJSTransformClient, splitIntoSizedBatches, JS_MAX_IN_FLIGHT_REQUESTS, JS_BATCH_MAX_BYTES
+from transformPYFiles import formatPYFiles, pyTransformerFingerprint
+from transformCache import TransformCache
+from commitPipeline import CommitPipeline
+from runMetrics import CommitMetrics, RunMetrics
+from repoSetup import setUpOutputRepo
+from objectPacker import ObjectPacker, PACK_INTERVAL
 
 
 GIT_DIFF_FIND_ALL = 0x0ff
 
+JOURNAL_FILENAME = "rewritten-commits.journal"
+JOURNAL_CHECKPOINT_INTERVAL = 50
+
+# How many upcoming commits get diffed and transformed ahead of the one being written
+PIPELINE_LOOKAHEAD = 8
+PIPELINE_WORKERS = 4
+
+# Sync mode overwrites the already-rewritten refs with the source refs; the processor maps them back afterwards
+SYNC_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+# Commit messages reference other commits ("reverts abc1234"), point them at the rewritten ones
+REWRITE_COMMIT_REFERENCES = True
+
+# Build each rewritten tree by reading the whole parent tree into the index and writing it back, instead of
+# patching only the changed paths of the parent tree
+REWRITE_WITH_INDEX = False
+
+# Per-commit stage timings and counters, one JSON object per line, next to the journal
+METRICS_FILENAME = "rewrite-metrics.jsonl"
+# Set to e.g. a node_exporter textfile collector path to get the run totals as Prometheus metrics
+PROMETHEUS_METRICS_PATH = None
+
+# How a fresh output repo gets its objects: "clone" copies all of them, "hardlink" links the source's object files,
+# "alternates" reads them from the source repo in place (see repoSetup.py)
+OUTPUT_REPO_CLONE_MODE = "clone"
+
+# The rewritten objects are moved from loose files into a pack every this many commits (see objectPacker.py)
+OBJECT_PACK_INTERVAL = PACK_INTERVAL
+
+# Two-phase rewrite: first transform every distinct JS/PY blob of the history into the transform cache, in large
+# batches spread over all cores, then replay the commits with cache hits only (see transformUniqueBlobs)
+TWO_PHASE_REWRITE = False
+# Phase one batches hold at most this many files, and at most JS_BATCH_MAX_BYTES of source for JS
+UNIQUE_BLOB_BATCH_FILES = 200
+# Batches in flight at the JS transform server, which spreads each batch over its own worker pool
+UNIQUE_BLOB_JS_REQUESTS = 4
+UNIQUE_BLOB_PY_WORKERS = os.cpu_count() or 4
+
 def createFileEntry(repo, diffEntry):
     nf = diffEntry.new_file
-    fileBlob = repo[nf.id]
+    return createBlobFileEntry(repo, nf.path, nf.mode, nf.id)
+
+def createBlobFileEntry(repo, path, mode, blobId):
+    fileBlob = repo[blobId]
 
     return {
-        "name" : nf.path,
-        "mode" : nf.mode,
-        "hash" : str(nf.id),
+        "name" : path,
+        "mode" : mode,
+        "hash" : str(blobId),
         "source" : fileBlob.read_raw()
     }
 
+def formatPYBlobs(repositoryPath, files):
+    """
+    Formats (path, mode, blob ID) files in a worker process, which reads the blobs from its own repository
+    """
+    repo = pygit2.Repository(repositoryPath)
+    return formatPYFiles([createBlobFileEntry(repo, path, mode, blobId) for path, mode, blobId in files])
+
 def createTransformedEntry(fileEntry):
     return (fileEntry["name"], fileEntry["mode"], fileEntry["source"])
 
+# Transformed file contents are (path, mode, source), other files are (path, mode, blob ID).
+# Merges: mergedFiles are (path, mode, parent index) of files whose transformed contents are taken from that rewritten
+# parent, sameTreeParent is the index of a parent with the very same tree, if any.
+# metrics are the CommitMetrics collected while preparing, completed when the commit is written.
+# pendingJSFiles are the JS transforms still in flight at the transform server, if any (see completePreparedCommit).
+PreparedCommit = namedtuple("PreparedCommit", ["removedPaths", "jsPaths", "pyPaths", "transformedFiles", "otherFiles",
+                                               "mergedFiles", "sameTreeParent", "metrics", "pendingJSFiles"])
+
+# Cache lookups of a commit's JS files, and either the rewritten cache misses or a future per cache miss
+PendingJSFiles = namedtuple("PendingJSFiles", ["cachedEntries", "missingEntries", "missingClasses",
+                                               "rewrittenFileEntries", "fileFutures"])
+
 
 class MyRepoProcessor(RepositoryProcessor):
-    def __init__(self, repository: pygit2.Repository, firstBadCommit = None):
-        super().__init__(repository)
+    def __init__(self, repository: pygit2.Repository, firstBadCommit = None, journal = None,
+                 lookahead = PIPELINE_LOOKAHEAD, transformCache = None, useIndex = REWRITE_WITH_INDEX,
+                 runMetrics = None, objectPacker = None, twoPhase = TWO_PHASE_REWRITE,
+                 jsInFlight = JS_MAX_IN_FLIGHT_REQUESTS):
+        super().__init__(repository, journal=journal, rewrite_commit_references=REWRITE_COMMIT_REFERENCES)
+
+        self.jsFingerprint = jsTransformerFingerprint()
+        self.pyFingerprint = pyTransformerFingerprint()
+        self.transformCache = transformCache
+        self.useIndex = useIndex
+        self.runMetrics = runMetrics if runMetrics is not None else RunMetrics()
+        self.objectPacker = objectPacker
+        self.twoPhase = twoPhase
+
+        if twoPhase and transformCache is None:
+            raise ValueError("A two-phase rewrite needs a transform cache")
+
+        # Prepared commits leave their JS transforms in flight at the transform server, up to jsInFlight requests
+        # at once; with 0, the pipeline workers wait for them
+        self.jsClient = AsyncJSTransformClient(jsInFlight) if jsInFlight > 0 else None
+
+        self.commitPipeline = CommitPipeline(repository, self.prepareCommit, lookahead, PIPELINE_WORKERS)
 
         self.currentCommitNumber = 0
         self.totalCommits = 0
-        self.allCommitIds = set()
+        self.allCommitIds = OidSet()
 
         self.seenFirstBadCommit = False
         self.firstBadCommit = firstBadCommit
 
 
+    def process(self):
+        # The pipeline's workers are shut down even when a commit fails
+        with self.commitPipeline:
+            super().process()
+
     def on_commit_loaded(self, sha1):
         self.allCommitIds.add(sha1)
 
+    def on_journal_replayed(self, commitCount):
+        if commitCount:
+            print("Resuming: {0} commits were already rewritten".format(commitCount))
+
     def on_begin_load(self):
         print("Loading existing commits...")
 
     def on_end_load(self):
         self.totalCommits = len(self.allCommitIds)
-        print("Loaded {0} commits".format(self.totalCommits))
+        print("Loaded {0} commits in {1: >#0.3f}s ({2} other objects skipped)".format(
+            self.totalCommits, self.load_time, self.skipped_objects)
+        )
 
     def on_begin_processing(self):
         print("Processing commits...".format(self.totalCommits))
@@ -60,7 +165,7 @@ class MyRepoProcessor(RepositoryProcessor):
         endTime = time.time()
         elapsedTime = endTime - self.startTime
 
-        secondsPerCommit = elapsedTime / self.currentCommitNumber
+        secondsPerCommit = elapsedTime / max(self.currentCommitNumber, 1)
         commitsRemaining = self.totalCommits - self.currentCommitNumber
         numSecondsRemaining = commitsRemaining * secondsPerCommit
 
@@ -73,6 +178,12 @@ class MyRepoProcessor(RepositoryProcessor):
     def on_end_processing(self):
         secondsPerCommit, elapsedString, etaString = self.calculateProgressTimes()
 
+        if self.jsClient is not None:
+            self.jsClient.close()
+        if self.transformCache is not None:
+            print(self.transformCache.statsMessage())
+        print(self.runMetrics.summaryMessage())
+
         print("\nCommit processing complete. Total time: {0} ({1: >#0.3f}s/commit)".format(elapsedString, secondsPerCommit))
         print("Rewriting refs...")
 
@@ -88,18 +199,261 @@ class MyRepoProcessor(RepositoryProcessor):
         )
         print("{0} ({1}): {2}".format(dateString, authorName, firstMessageLine))
 
+    def on_commits_queued(self, queue):
+        if self.twoPhase:
+            self.transformUniqueBlobs(queue)
+        self.commitPipeline.schedule(queue)
+
+    def transformUniqueBlobs(self, commitIds):
+        """
+        Phase one of a two-phase rewrite: transforms every distinct JS and PY blob the commits change into the
+        transform cache, in batches of unrelated files that keep the JS transform server and all local cores busy.
+        The commits are then replayed as usual, and find their results in the cache.
+        Anything missed here (failed batches, first-match dependent files) is still transformed during the replay.
+        """
+        print("Collecting distinct JS and PY blobs...")
+        startTime = time.time()
+        jsBlobs, pyBlobs = self.collectUniqueBlobs(commitIds)
+        print("{0} JS and {1} PY blobs are not cached yet".format(len(jsBlobs), len(pyBlobs)))
+
+        # Blob sizes are what the sources weigh before the unicode normalization, which barely changes them
+        jsBatches = [batch for batch, _ in splitIntoSizedBatches(list(jsBlobs.items()), self.jsBlobSize,
+                                                                  JS_BATCH_MAX_BYTES, UNIQUE_BLOB_BATCH_FILES)]
+        pyBatches = splitIntoBatches([(path, mode, blobId.hex) for (blobId, _), (path, mode) in pyBlobs.items()],
+                                     UNIQUE_BLOB_BATCH_FILES)
+
+        # Spawned, not forked: the JS threads may hold libgit2 or SQLite locks at fork time
+        processContext = multiprocessing.get_context("spawn")
+        with ThreadPoolExecutor(UNIQUE_BLOB_JS_REQUESTS) as jsExecutor, \
+                ProcessPoolExecutor(UNIQUE_BLOB_PY_WORKERS, mp_context=processContext) as pyExecutor:
+            jsFutures = [jsExecutor.submit(self.transformJSBatch, batchNumber, batch)
+                         for batchNumber, batch in enumerate(jsBatches)]
+            pyFutures = [pyExecutor.submit(formatPYBlobs, self._repository.path, batch) for batch in pyBatches]
+
+            for batchNumber, future in enumerate(as_completed(pyFutures)):
+                for fileEntry in future.result():
+                    # Failed ones are left to the replay
+                    if not fileEntry.get("failed"):
+                        self.transformCache.put(fileEntry["hash"], "py", self.pyFingerprint, fileEntry["source"])
+                print("PY batch {0}/{1} done".format(batchNumber + 1, len(pyBatches)))
+
+            for future in jsFutures:
+                future.result()
+
+        elapsedTime = time.time() - startTime
+        elapsedString = ddhhmmss(int(elapsedTime)) if elapsedTime >= 60 else "{0: >#0.3f}s".format(elapsedTime)
+        print("Transformed distinct blobs in {0}\n".format(elapsedString))
+
+    def collectUniqueBlobs(self, commitIds):
+        """
+        Every distinct (blob ID, path class) among the JS and PY files the commits change, which is not cached yet.
+        JS files that a first-match fixup may apply to are left out, their result depends on the rest of their commit.
+        :return: dicts of (blob ID, path class) -> (path, mode), for JS and for PY
+        """
+        repo = self._repository
+        jsBlobs = {}
+        pyBlobs = {}
+
+        for commitId in commitIds:
+            commit = repo[commitId]
+            # Root commits are copied as they are
+            if not commit.parent_ids:
+                continue
+
+            # Rename and copy detection does not change which blobs a commit adds, so find_similar is not needed
+            for delta in repo.diff(commit.parents[0], commit).deltas:
+                if delta.status_char() == 'D':
+                    continue
+
+                path = delta.new_file.path
+                if isFormattableJSSourceFile(path):
+                    if isSkippedFile(path) or isFirstMatchDependent(path):
+                        continue
+                    blobs, pathClass, fingerprint = jsBlobs, jsPathClasses([{"name" : path}])[0], self.jsFingerprint
+                elif isFormattablePythonSourceFile(path):
+                    blobs, pathClass, fingerprint = pyBlobs, "py", self.pyFingerprint
+                else:
+                    continue
+
+                key = (delta.new_file.id, pathClass)
+                if key not in blobs and not self.transformCache.contains(delta.new_file.id, pathClass, fingerprint):
+                    blobs[key] = (path, delta.new_file.mode)
+
+        return (jsBlobs, pyBlobs)
+
+    def jsBlobSize(self, jsBlob):
+        (blobId, _), _ = jsBlob
+        return self._repository[blobId].size
+
+    def transformJSBatch(self, batchNumber, batch):
+        """
+        Runs on a phase one thread: transforms a batch of ((blob ID, path class), (path, mode)) and caches the results
+        """
+        repo = pygit2.Repository(self._repository.path)
+        fileEntries = [createBlobFileEntry(repo, path, mode, blobId) for (blobId, _), (path, mode) in batch]
+        pathClasses = [pathClass for (_, pathClass), _ in batch]
+
+        try:
+            rewrittenFileEntries = rewriteAvailableJSFiles("unique-blobs-{0}".format(batchNumber), fileEntries)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Left to the replay
+            print("JS batch {0} failed: {1}".format(batchNumber + 1, e))
+            return
+
+        self.storeCachedResults(rewrittenFileEntries, fileEntries, pathClasses, self.jsFingerprint)
+        print("JS batch {0} done".format(batchNumber + 1))
+
     def filter_commit(self, commit_id, author, committer, message, tree, parents):
         self.currentCommitNumber += 1
         currentCommit = self._repository[commit_id]
         self.printCommitProgressMessage(currentCommit)
 
-        rewrittenCommitId = self.rewriteCommit(currentCommit, author, committer, message, tree, parents)
+        waitStartTime = time.perf_counter()
+        preparedCommit = self.commitPipeline.take(commit_id)
+        metrics = preparedCommit.metrics if preparedCommit is not None else CommitMetrics(commit_id)
+        metrics.stageTimes["pipelineWait"] += time.perf_counter() - waitStartTime
+        preparedCommit = self.completePreparedCommit(preparedCommit)
+
+        rewrittenCommitId = self.rewriteCommit(currentCommit, preparedCommit, author, committer, message, tree, parents, metrics)
+        if self.objectPacker is not None:
+            with metrics.stage("packObjects"):
+                self.objectPacker.commitWritten()
+        self.runMetrics.record(metrics)
 
         print("Rewrote {0} to {1}\n".format(currentCommit.id, rewrittenCommitId))
 
         return rewrittenCommitId
 
-    def rewriteCommit(self, currentCommit, author, committer, message, tree, parents):
+    def prepareCommit(self, repo, commitId, reuseMergedFiles = True, metrics = None):
+        """
+        Everything about a commit's rewrite that only depends on the original commit: its diff against the first
+        original parent, and the transformed contents of its changed JS and PY files.
+        Runs on the pipeline's worker threads, with their own `repo`.
+        """
+        currentCommit = repo[commitId]
+        if not currentCommit.parent_ids:
+            return None
+
+        if metrics is None:
+            metrics = CommitMetrics(commitId)
+
+        isMerge = reuseMergedFiles and len(currentCommit.parent_ids) > 1
+        if isMerge:
+            for parentIndex, parentCommit in enumerate(currentCommit.parents):
+                if parentCommit.tree_id == currentCommit.tree_id:
+                    return PreparedCommit([], [], [], [], [], [], parentIndex, metrics, None)
+
+        # Look up the original parent commit
+        parentCommit = currentCommit.parents[0]
+
+        # Calculate the original diff for this commit
+        with metrics.stage("diff"):
+            diff = repo.diff(parentCommit, currentCommit)
+
+        diffOptions = pygit2.GIT_DIFF_FIND_RENAMES | pygit2.GIT_DIFF_FIND_AND_BREAK_REWRITES
+
+        with metrics.stage("findSimilar"):
+            diff.find_similar(GIT_DIFF_FIND_ALL, rename_threshold=85)
+
+        changedJSFiles, changedPYFiles, allOtherFiles, removedPaths = self.filterChangedFiles(diff)
+
+        mergedFiles = []
+        if isMerge:
+            with metrics.stage("mergeLookup"):
+                changedJSFiles, changedPYFiles, mergedFiles = self.findMergedFiles(currentCommit, changedJSFiles, changedPYFiles)
+
+        metrics.count("jsFiles", len(changedJSFiles))
+        metrics.count("pyFiles", len(changedPYFiles))
+        metrics.count("otherFiles", len(allOtherFiles))
+        metrics.count("removedFiles", len(removedPaths))
+
+        currentCommitId = str(currentCommit.id)
+        transformedFiles = []
+        pendingJSFiles = self.startJSTransforms(repo, currentCommitId, changedJSFiles, metrics)
+        if self.jsClient is None:
+            transformedFiles.extend(self.finishJSTransforms(pendingJSFiles, metrics))
+            pendingJSFiles = None
+        transformedFiles.extend(self.transformPYFiles(repo, changedPYFiles, metrics))
+
+        return PreparedCommit(
+            removedPaths=removedPaths,
+            jsPaths=[delta.new_file.path for delta in changedJSFiles],
+            pyPaths=[delta.new_file.path for delta in changedPYFiles],
+            transformedFiles=transformedFiles,
+            otherFiles=[(delta.new_file.path, delta.new_file.mode, delta.new_file.id) for delta in allOtherFiles],
+            mergedFiles=mergedFiles,
+            sameTreeParent=None,
+            metrics=metrics,
+            pendingJSFiles=pendingJSFiles,
+        )
+
+    def findMergedFiles(self, currentCommit, changedJSFiles, changedPYFiles):
+        """
+        Files a merge brings in from another branch have the same blob in that parent, and were transformed when
+        that branch was rewritten. Splits them off the files that still need transforming.
+        """
+        otherParentTrees = [(parentIndex, parentCommit.tree) for parentIndex, parentCommit in enumerate(currentCommit.parents)
+                            if parentIndex > 0]
+
+        def mergedFromParent(delta):
+            for parentIndex, parentTree in otherParentTrees:
+                try:
+                    if parentTree[delta.new_file.path].id == delta.new_file.id:
+                        return parentIndex
+                except KeyError:
+                    pass
+            return None
+
+        mergedFiles = []
+        remainingFiles = []
+        for changedFiles in (changedJSFiles, changedPYFiles):
+            merged = []
+            remaining = []
+            for delta in changedFiles:
+                parentIndex = mergedFromParent(delta)
+                if parentIndex is None:
+                    remaining.append(delta)
+                else:
+                    merged.append((delta.new_file.path, delta.new_file.mode, parentIndex))
+            mergedFiles.append(merged)
+            remainingFiles.append(remaining)
+
+        mergedJSFiles, mergedPYFiles = mergedFiles
+        remainingJSFiles, remainingPYFiles = remainingFiles
+
+        # Leaving files out must not change how the rest of the JS files get transformed
+        if mergedJSFiles:
+            allClasses = jsPathClasses([{"name" : delta.new_file.path} for delta in changedJSFiles])
+            remainingClasses = jsPathClasses([{"name" : delta.new_file.path} for delta in remainingJSFiles])
+            remainingDeltas = set(map(id, remainingJSFiles))
+            expectedClasses = [pathClass for delta, pathClass in zip(changedJSFiles, allClasses) if id(delta) in remainingDeltas]
+            if remainingClasses != expectedClasses or (remainingClasses and all(pathClass == "skip" for pathClass in remainingClasses)):
+                mergedJSFiles, remainingJSFiles = [], changedJSFiles
+
+        return (remainingJSFiles, remainingPYFiles, mergedJSFiles + mergedPYFiles)
+
+    def resolveMergedFiles(self, currentCommit, preparedCommit, metrics):
+        """
+        Looks up the transformed blobs of a merge's files in its other rewritten parents.
+        :return: the prepared commit with those files added to otherFiles, or None if one of them is missing
+        """
+        if not preparedCommit.mergedFiles:
+            return preparedCommit
+
+        resolvedFiles = []
+        for path, mode, parentIndex in preparedCommit.mergedFiles:
+            rewrittenParent = self.replaced_commits.get(currentCommit.parent_ids[parentIndex])
+            if not isinstance(rewrittenParent, pygit2.Oid):
+                return None
+            try:
+                resolvedFiles.append((path, mode, self._repository[rewrittenParent].tree[path].id))
+            except KeyError:
+                return None
+
+        metrics.count("mergedFiles", len(resolvedFiles))
+        return preparedCommit._replace(otherFiles=preparedCommit.otherFiles + resolvedFiles, mergedFiles=[])
+
+    def rewriteCommit(self, currentCommit, preparedCommit, author, committer, message, tree, parents, metrics):
         destRepo = self._repository
 
         shouldSkipCommit = False
@@ -109,13 +463,26 @@ class MyRepoProcessor(RepositoryProcessor):
             shouldSkipCommit = not self.seenFirstBadCommit
 
         if not parents or shouldSkipCommit:
-            return destRepo.create_commit(None, author, committer, message, tree, parents)
+            with metrics.stage("createCommit"):
+                return destRepo.create_commit(None, author, committer, message, tree, parents)
         else:
 
-            index = destRepo.index
+            if preparedCommit.sameTreeParent is not None:
+                rewrittenParent = self.replaced_commits.get(currentCommit.parent_ids[preparedCommit.sameTreeParent])
+                if isinstance(rewrittenParent, pygit2.Oid):
+                    print("Merge keeps the tree of parent {0}".format(preparedCommit.sameTreeParent + 1))
+                    metrics.count("sameTreeMerges")
+                    with metrics.stage("createCommit"):
+                        return destRepo.create_commit(None, author, committer, message, destRepo[rewrittenParent].tree_id, parents)
+                preparedCommit = None
+            else:
+                preparedCommit = self.resolveMergedFiles(currentCommit, preparedCommit, metrics)
 
-            # Look up the original parent commit
-            parentCommit = currentCommit.parents[0]
+            if preparedCommit is None:
+                # Other branch was not rewritten the usual way, transform everything against the first parent
+                metrics.count("mergeFallbacks")
+                preparedCommit = self.prepareCommit(destRepo, currentCommit.id, reuseMergedFiles=False, metrics=metrics)
+                preparedCommit = self.completePreparedCommit(preparedCommit)
 
             # The base class already looked up rewritten commit IDs
             rewrittenParentHash = parents[0]
@@ -123,35 +490,75 @@ class MyRepoProcessor(RepositoryProcessor):
             # Look up that commit object too
             rewrittenParentCommit = destRepo[rewrittenParentHash]
 
-            # Reset the index to the previously-rewritten commit as our starting point
-            index.read_tree(rewrittenParentCommit.tree)
+            if self.useIndex:
+                newTreeId = self.rewriteTreeWithIndex(rewrittenParentCommit.tree, preparedCommit, metrics)
+            else:
+                newTreeId = self.patchParentTree(rewrittenParentCommit.tree, preparedCommit, metrics)
 
-            # Calculate the original diff for this commit
-            diff = destRepo.diff(parentCommit, currentCommit)
+            with metrics.stage("createCommit"):
+                return destRepo.create_commit(None, author, committer, message, newTreeId, parents)
 
-            diffOptions = pygit2.GIT_DIFF_FIND_RENAMES | pygit2.GIT_DIFF_FIND_AND_BREAK_REWRITES
+    def rewriteTreeWithIndex(self, rewrittenParentTree, preparedCommit, metrics):
+        index = self._repository.index
 
-            diff.find_similar(GIT_DIFF_FIND_ALL, rename_threshold=85)
+        # Reset the index to the previously-rewritten commit as our starting point
+        with metrics.stage("readTree"):
+            index.read_tree(rewrittenParentTree)
+
+        print("Checking deltas...")
+        for removedPath in preparedCommit.removedPaths:
+            self.removeFileFromIndex(removedPath)
+
+        with metrics.stage("writeTree"):
+            return self.writeChangedFiles(preparedCommit)
+
+    def patchParentTree(self, rewrittenParentTree, preparedCommit, metrics):
+        """
+        Same result as rewriteTreeWithIndex, but only the directories on the changed paths get rewritten.
+        """
+        destRepo = self._repository
+
+        print("Checking deltas...")
+        operations = [("rm", path, None) for path in preparedCommit.removedPaths]
+
+        if preparedCommit.jsPaths or preparedCommit.pyPaths:
+            print("Transforming JS+PY files...")
 
-            print("Checking deltas...")
-            filteredFiles = self.filterChangedFiles(diff)
+            for path in preparedCommit.jsPaths + preparedCommit.pyPaths:
+                operations.append(("rm", path, None))
 
-            newTreeId = self.transformChangedFiles(currentCommit, *filteredFiles)
+            for path in preparedCommit.jsPaths:
+                print("JS: " + path)
 
-            return destRepo.create_commit(None, author, committer, message, newTreeId, parents)
+            for path in preparedCommit.pyPaths:
+                print("PY: " + path)
+
+            with metrics.stage("blobWrites"):
+                for filePath, fileMode, transformedFileContents in preparedCommit.transformedFiles:
+                    newBlobId = destRepo.create_blob(transformedFileContents)
+                    operations.append(("insert", filePath, FileEntry(newBlobId.hex, fileMode)))
+
+        for path, mode, blobId in preparedCommit.otherFiles:
+            operations.append(("insert", path, FileEntry(blobId.hex, mode)))
+
+        with metrics.stage("writeTree"):
+            tree = TreeProcessor.TreeWrapper(destRepo, rewrittenParentTree)
+            tree.apply(operations)
+            return tree.hex()
 
 
     def filterChangedFiles(self, diff):
         changedJSFiles = []
         changedPYFiles = []
         allOtherFiles = []
+        removedPaths = []
 
         for delta in diff.deltas:
             statusChar = delta.status_char()
             # Check for any modified or added files
             if statusChar in ('M', 'A', 'R', 'C'):
                 if statusChar == 'R':
-                    self.removeFileFromIndex(delta.old_file.path)
+                    removedPaths.append(delta.old_file.path)
 
                 if (isFormattableJSSourceFile(delta.new_file.path)):
                     changedJSFiles.append(delta)
@@ -160,82 +567,169 @@ class MyRepoProcessor(RepositoryProcessor):
                 else:
                     allOtherFiles.append(delta)
             elif statusChar == 'D':
-                self.removeFileFromIndex(delta.old_file.path)
+                removedPaths.append(delta.old_file.path)
             else:
                 q = 42
                 raise Exception("Unexpected delta status type!")
 
-        return (changedJSFiles, changedPYFiles, allOtherFiles)
+        return (changedJSFiles, changedPYFiles, allOtherFiles, removedPaths)
 
 
 
-    def transformChangedFiles(self, currentCommit, changedJSFiles, changedPYFiles, allOtherFiles):
-        transformedFiles = []
-
+    def writeChangedFiles(self, preparedCommit):
         destRepo = self._repository
         index = destRepo.index
 
-        if changedJSFiles or changedPYFiles:
+        if preparedCommit.jsPaths or preparedCommit.pyPaths:
             print("Transforming JS+PY files...")
 
-            for delta in changedJSFiles + changedPYFiles:
-                new_file = delta.new_file
+            for path in preparedCommit.jsPaths + preparedCommit.pyPaths:
                 # Remove the existing entry, if any:
                 try:
-                    index.remove(new_file.path)
+                    index.remove(path)
                 except:
                     pass
 
-            for delta in changedJSFiles:
-                print("JS: " + delta.new_file.path)
-
-            for delta in changedPYFiles:
-                print("PY: " + delta.new_file.path)
+            for path in preparedCommit.jsPaths:
+                print("JS: " + path)
 
-            currentCommitId = str(currentCommit.id)
-            transformedJSFiles = self.transformJSFiles(currentCommitId, changedJSFiles)
-            transformedFiles.extend(transformedJSFiles)
+            for path in preparedCommit.pyPaths:
+                print("PY: " + path)
 
-            transformedPYFiles = self.transformPYFiles(changedPYFiles)
-            transformedFiles.extend(transformedPYFiles)
-
-            for originalFilePath, originalFileMode, transformedFileContents in transformedFiles:
+            for originalFilePath, originalFileMode, transformedFileContents in preparedCommit.transformedFiles:
                 newBlobId = destRepo.create_blob(transformedFileContents)
                 fileBlob = destRepo[newBlobId]
 
                 self.addFileToIndex((originalFilePath, originalFileMode), fileBlob=fileBlob)#externalPath=transformedFilePath)
 
-        for delta in allOtherFiles:
+        for path, mode, blobId in preparedCommit.otherFiles:
             # Replicate all other file operations
-            nf = delta.new_file
-            fileBlob = destRepo[nf.id]
-            self.addFileToIndex((nf.path, nf.mode), fileBlob=fileBlob)
+            fileBlob = destRepo[blobId]
+            self.addFileToIndex((path, mode), fileBlob=fileBlob)
 
         newTreeId = index.write_tree()
         return newTreeId
 
-    def transformJSFiles(self, currentCommitId, changedJSFiles):
+    def completePreparedCommit(self, preparedCommit):
+        """
+        Waits for the JS transforms a prepared commit still has in flight, on the main thread
+        """
+        if preparedCommit is None or preparedCommit.pendingJSFiles is None:
+            return preparedCommit
+
+        transformedFiles = self.finishJSTransforms(preparedCommit.pendingJSFiles, preparedCommit.metrics)
+        return preparedCommit._replace(transformedFiles=transformedFiles + preparedCommit.transformedFiles,
+                                       pendingJSFiles=None)
+
+    def startJSTransforms(self, repo, currentCommitId, changedJSFiles, metrics):
+        """
+        Looks up the cached results of the changed JS files and transforms the rest, or only submits them to the
+        transform client when there is one
+        """
         if not changedJSFiles:
+            return None
+
+        with metrics.stage("readBlobs"):
+            jsFileEntries = [createFileEntry(repo, diffEntry) for diffEntry in changedJSFiles]
+        metrics.count("jsBytes", sum(len(fileEntry["source"]) for fileEntry in jsFileEntries))
+
+        pathClasses = jsPathClasses(jsFileEntries)
+        with metrics.stage("cacheLookup"):
+            lookUpResults = self.lookUpCachedResults(jsFileEntries, pathClasses, self.jsFingerprint, metrics)
+        cachedEntries, missingEntries, missingClasses = lookUpResults
+
+        # Sending only the cache misses must not change which files get the first-match fixups
+        if jsPathClasses(missingEntries) != missingClasses:
+            cachedEntries, missingEntries, missingClasses = [], jsFileEntries, pathClasses
+
+        if cachedEntries and all(pathClass == "skip" for pathClass in missingClasses):
+            # rewriteAvailableJSFiles drops skipped files when nothing else is left to transform
+            rewrittenFileEntries = list(map(normalizeEntry, missingEntries))
+        elif missingEntries and self.jsClient is not None:
+            fileFutures = self.jsClient.submit(currentCommitId, missingEntries, metrics)
+            metrics.count("jsFilesSent", len(missingEntries))
+            return PendingJSFiles(cachedEntries, missingEntries, missingClasses, None, fileFutures)
+        else:
+            # Records the jsFixups, jsTransform and jsTransport stages
+            rewrittenFileEntries = rewriteAvailableJSFiles(currentCommitId, missingEntries, metrics) if missingEntries else []
+            metrics.count("jsFilesSent", len(missingEntries))
+
+        return PendingJSFiles(cachedEntries, missingEntries, missingClasses, rewrittenFileEntries, None)
+
+    def finishJSTransforms(self, pendingJSFiles, metrics):
+        if pendingJSFiles is None:
             return []
 
-        destRepo = self._repository
-        jsFileEntries = [createFileEntry(destRepo, diffEntry) for diffEntry in changedJSFiles]
-        rewrittenFileEntries = rewriteAvailableJSFiles(currentCommitId, jsFileEntries)
-        transformationEntries = list(map(createTransformedEntry, rewrittenFileEntries))
+        rewrittenFileEntries = pendingJSFiles.rewrittenFileEntries
+        if rewrittenFileEntries is None:
+            with metrics.stage("jsWait"):
+                fileResults = [fileFuture.result() for fileFuture in pendingJSFiles.fileFutures]
+            rewrittenFileEntries = [fileEntry for fileEntry in fileResults if fileEntry is not None]
+
+        with metrics.stage("cacheStore"):
+            self.storeCachedResults(rewrittenFileEntries, pendingJSFiles.missingEntries, pendingJSFiles.missingClasses,
+                                    self.jsFingerprint)
+        transformationEntries = list(map(createTransformedEntry, pendingJSFiles.cachedEntries + rewrittenFileEntries))
 
         return transformationEntries
 
-    def transformPYFiles(self, changedPYFiles):
+    def transformPYFiles(self, repo, changedPYFiles, metrics):
         if not changedPYFiles:
             return []
 
-        destRepo = self._repository
-        pyFileEntries = [createFileEntry(destRepo, diffEntry) for diffEntry in changedPYFiles]
-        rewrittenFileEntries = formatPYFiles(pyFileEntries)
-        transformationEntries = list(map(createTransformedEntry, rewrittenFileEntries))
+        with metrics.stage("readBlobs"):
+            pyFileEntries = [createFileEntry(repo, diffEntry) for diffEntry in changedPYFiles]
+        metrics.count("pyBytes", sum(len(fileEntry["source"]) for fileEntry in pyFileEntries))
+
+        pathClasses = ["py"] * len(pyFileEntries)
+        with metrics.stage("cacheLookup"):
+            lookUpResults = self.lookUpCachedResults(pyFileEntries, pathClasses, self.pyFingerprint, metrics)
+        cachedEntries, missingEntries, missingClasses = lookUpResults
+
+        with metrics.stage("pyFormat"):
+            rewrittenFileEntries = formatPYFiles(missingEntries)
+
+        with metrics.stage("cacheStore"):
+            self.storeCachedResults(rewrittenFileEntries, missingEntries, missingClasses, self.pyFingerprint)
+        transformationEntries = list(map(createTransformedEntry, cachedEntries + rewrittenFileEntries))
 
         return transformationEntries
 
+    def lookUpCachedResults(self, fileEntries, pathClasses, fingerprint, metrics):
+        if self.transformCache is None:
+            return ([], fileEntries, pathClasses)
+
+        cachedEntries = []
+        missingEntries = []
+        missingClasses = []
+
+        for fileEntry, pathClass in zip(fileEntries, pathClasses):
+            # Skipped files are never transformed, there is nothing to cache
+            cachedSource = None if pathClass == "skip" else self.transformCache.get(fileEntry["hash"], pathClass, fingerprint)
+
+            if cachedSource is None:
+                missingEntries.append(fileEntry)
+                missingClasses.append(pathClass)
+            else:
+                cachedEntries.append(update(fileEntry, {"source" : cachedSource}))
+
+        metrics.count("cacheHits", len(cachedEntries))
+        metrics.count("cacheMisses", len(missingEntries))
+        return (cachedEntries, missingEntries, missingClasses)
+
+    def storeCachedResults(self, rewrittenFileEntries, originalEntries, pathClasses, fingerprint):
+        if self.transformCache is None:
+            return
+
+        pathClassesByName = {fileEntry["name"] : pathClass for fileEntry, pathClass in zip(originalEntries, pathClasses)}
+
+        for fileEntry in rewrittenFileEntries:
+            pathClass = pathClassesByName.get(fileEntry["name"], "skip")
+            # Failed transforms fall back to the original source; retry them next time
+            if pathClass == "skip" or fileEntry.get("failed"):
+                continue
+            self.transformCache.put(fileEntry["hash"], pathClass, fingerprint, fileEntry["source"])
+
     def addFileToIndex(self, fileAttributes, fileBlob=None, externalPath=None, ):
         destRepo = self._repository
         index = destRepo.index
@@ -270,21 +764,64 @@ class MyRepoProcessor(RepositoryProcessor):
             pass
 
 
-def main(sourcePath = SOURCE_REPO_PATH, destPath = OUTPUT_REPO_PATH):
+def splitIntoBatches(items, batchSize):
+    return [items[start:start + batchSize] for start in range(0, len(items), batchSize)]
+
+
+def fetchNewSourceCommits(destRepo, strSourcePath):
+    if "origin" in [remote.name for remote in destRepo.remotes]:
+        destRepo.remotes.set_url("origin", strSourcePath)
+        remote = destRepo.remotes["origin"]
+    else:
+        remote = destRepo.remotes.create("origin", strSourcePath)
+
+    stats = remote.fetch(SYNC_REFSPECS)
+    print("Fetched {0} new objects".format(stats.received_objects))
+
+
+def main(sourcePath = SOURCE_REPO_PATH, destPath = OUTPUT_REPO_PATH, resume = False, sync = False,
+         cloneMode = OUTPUT_REPO_CLONE_MODE, twoPhase = TWO_PHASE_REWRITE):
     strSourcePath = str(sourcePath)
     strDestPath = str(destPath)
 
-    print("Deleting existing repo...")
-    if destPath.exists():
-        shutil.rmtree(strDestPath)
+    journalPath = destPath / JOURNAL_FILENAME
 
-    print("Cloning repo at {0} to {1}".format(strSourcePath, strDestPath))
-    destRepo = pygit2.clone_repository(strSourcePath, strDestPath, True)
+    if sync and journalPath.exists():
+        print("Syncing new commits from {0} into {1}".format(strSourcePath, strDestPath))
+        destRepo = pygit2.Repository(strDestPath)
+        fetchNewSourceCommits(destRepo, strSourcePath)
+    elif resume and destPath.exists():
+        print("Resuming conversion in existing repo at {0}".format(strDestPath))
+        destRepo = pygit2.Repository(strDestPath)
+    else:
+        if sync:
+            print("No previous conversion found at {0}, doing a full conversion".format(strDestPath))
 
-    repoProcessor = MyRepoProcessor(destRepo, firstBadCommit=None)
+        print("Deleting existing repo...")
+        if destPath.exists():
+            shutil.rmtree(strDestPath)
+
+        print("Cloning repo at {0} to {1} ({2})".format(strSourcePath, strDestPath, cloneMode))
+        destRepo = setUpOutputRepo(strSourcePath, strDestPath, cloneMode)
+
+    journal = CommitJournal(str(journalPath), JOURNAL_CHECKPOINT_INTERVAL)
+    transformCache = TransformCache(TRANSFORM_CACHE_PATH, [jsTransformerFingerprint(), pyTransformerFingerprint()])
+
+    runMetrics = RunMetrics(destPath / METRICS_FILENAME, PROMETHEUS_METRICS_PATH)
+    objectPacker = ObjectPacker(destRepo.path, OBJECT_PACK_INTERVAL)
+
+    repoProcessor = MyRepoProcessor(destRepo, firstBadCommit=None, journal=journal, transformCache=transformCache,
+                                    runMetrics=runMetrics, objectPacker=objectPacker, twoPhase=twoPhase)
     repoProcessor.process()
+    transformCache.close()
+    runMetrics.close()
+
+    print("Packing objects...")
+    objectPacker.finish()
 
     print("\nDone")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cloneModes = [arg[2:] for arg in sys.argv if arg in ("--hardlink", "--alternates")]
+    main(resume="--resume" in sys.argv, sync="--sync" in sys.argv, cloneMode=(cloneModes or [OUTPUT_REPO_CLONE_MODE])[0],
+         twoPhase=TWO_PHASE_REWRITE or "--two-phase" in sys.argv)
\ No newline at end of file
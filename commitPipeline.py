@@ -0,0 +1,82 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pygit2
+
+
+class CommitPipeline:
+    """
+    Prepares upcoming commits (diffing, classifying and transforming their changed files) on a pool of worker
+    threads, while the processor assembles and writes the current commit on the main thread.
+
+    Preparing a commit only reads the original commit and its original parents, so it can safely run ahead of the
+    rewrite. At most `lookahead` commits are prepared or waiting to be taken at any time. With a lookahead of 0,
+    every commit is prepared inline when it is taken.
+    """
+
+    def __init__(self, repository: pygit2.Repository, prepareCommit, lookahead = 8, numWorkers = 4):
+        self._repositoryPath = repository.path
+        self._prepareCommit = prepareCommit
+        self._lookahead = lookahead
+        self._localRepositories = threading.local()
+
+        self._pendingCommitIds = deque()
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=numWorkers) if lookahead > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def schedule(self, commitIds):
+        self._pendingCommitIds.extend(commitIds)
+
+    def take(self, commitId):
+        """
+        Returns the prepared data for commitId, blocking until it is available, and tops up the look-ahead window
+        """
+        self._fillWindow()
+
+        future = self._futures.pop(commitId, None)
+        self._fillWindow()
+
+        if future is None:
+            # Not scheduled, or scheduled past the window: prepare it right away
+            try:
+                self._pendingCommitIds.remove(commitId)
+            except ValueError:
+                pass
+            return self._prepareCommit(self._workerRepository(), commitId)
+        return future.result()
+
+    def close(self):
+        self._pendingCommitIds.clear()
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _fillWindow(self):
+        if self._executor is None:
+            return
+
+        while self._pendingCommitIds and len(self._futures) < self._lookahead:
+            commitId = self._pendingCommitIds.popleft()
+            if commitId not in self._futures:
+                self._futures[commitId] = self._executor.submit(self._prepareInWorker, commitId)
+
+    def _prepareInWorker(self, commitId):
+        return self._prepareCommit(self._workerRepository(), commitId)
+
+    def _workerRepository(self):
+        # pygit2 repository objects are not shared between threads; every worker opens its own
+        repository = getattr(self._localRepositories, "repository", None)
+        if repository is None:
+            repository = pygit2.Repository(self._repositoryPath)
+            self._localRepositories.repository = repository
+        return repository
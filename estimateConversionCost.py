@@ -0,0 +1,240 @@
+# Dry run of a full history conversion: loads and diffs every commit like cloneAndProcessRepo.py, but only measures.
+# Counts the JS/PY files and bytes each commit would send to the transforms, times real transforms on a sample of
+# commits and projects the total runtime and the largest payloads. Nothing is written to any repository.
+# The JS transform server has to be running for the JS projection.
+# Usage: python3 estimateConversionCost.py [sampleCount]
+
+from collections import namedtuple
+import sys
+import time
+
+import pygit2
+import requests
+
+from pylter_branch import RepositoryProcessor
+
+from repoFilterUtils import *
+
+from transformJSFiles import rewriteAvailableJSFiles
+from transformPYFiles import formatPYFiles
+from cloneAndProcessRepo import createFileEntry
+
+
+DEFAULT_SAMPLE_COUNT = 20
+SLOWEST_COMMITS_SHOWN = 10
+
+CommitCost = namedtuple("CommitCost", ["commitId", "jsFiles", "jsBytes", "pyFiles", "pyBytes", "diffTime"])
+
+
+class CostEstimator(RepositoryProcessor):
+    def __init__(self, repository: pygit2.Repository):
+        super().__init__(repository)
+
+        self.commitCosts = []
+        self.distinctJSBlobs = {}
+        self.distinctPYBlobs = {}
+
+    def on_begin_load(self):
+        print("Loading existing commits...")
+
+    def on_end_load(self):
+        print("Loaded commits in {0: >#0.3f}s ({1} other objects skipped)".format(self.load_time, self.skipped_objects))
+
+    def changedSourceFiles(self, commit):
+        """
+        The JS and PY deltas cloneAndProcessRepo would transform for this commit: changes against the first parent
+        """
+        diff = self._repository.diff(commit.parents[0], commit)
+
+        jsDeltas = []
+        pyDeltas = []
+        for delta in diff.deltas:
+            if delta.status_char() == 'D':
+                continue
+            if isFormattableJSSourceFile(delta.new_file.path):
+                jsDeltas.append(delta)
+            elif isFormattablePythonSourceFile(delta.new_file.path):
+                pyDeltas.append(delta)
+
+        return (jsDeltas, pyDeltas)
+
+    def blobSize(self, blobId, distinctBlobs):
+        size = distinctBlobs.get(blobId)
+        if size is None:
+            size = self._repository[blobId].size
+            distinctBlobs[blobId] = size
+        return size
+
+    def analyze(self):
+        queue = self.load()
+        print("Diffing {0} commits...".format(len(queue)))
+
+        for commitId in queue:
+            commit = self._repository[commitId]
+            # Root commits are copied as they are
+            if not commit.parent_ids:
+                continue
+
+            startTime = time.perf_counter()
+            jsDeltas, pyDeltas = self.changedSourceFiles(commit)
+            diffTime = time.perf_counter() - startTime
+
+            jsBytes = sum(self.blobSize(delta.new_file.id, self.distinctJSBlobs) for delta in jsDeltas)
+            pyBytes = sum(self.blobSize(delta.new_file.id, self.distinctPYBlobs) for delta in pyDeltas)
+            self.commitCosts.append(CommitCost(commitId, len(jsDeltas), jsBytes, len(pyDeltas), pyBytes, diffTime))
+
+    def timeSampleTransforms(self, sampleCount):
+        """
+        Runs the real transforms on commits spread over the range of payload sizes.
+        :return: lists of (bytes, seconds) for JS and PY, None for JS if the transform server is not reachable
+        """
+        jsCommits = sorted((cost for cost in self.commitCosts if cost.jsFiles), key=lambda cost: cost.jsBytes)
+        pyCommits = sorted((cost for cost in self.commitCosts if cost.pyFiles), key=lambda cost: cost.pyBytes)
+
+        jsTimings = []
+        for cost in spreadSample(jsCommits, sampleCount):
+            jsDeltas, _ = self.changedSourceFiles(self._repository[cost.commitId])
+            fileEntries = [createFileEntry(self._repository, delta) for delta in jsDeltas]
+
+            startTime = time.perf_counter()
+            try:
+                rewriteAvailableJSFiles(str(cost.commitId), fileEntries)
+            except requests.exceptions.RequestException:
+                print("JS transform server is not reachable, JS transforms are not projected")
+                jsTimings = None
+                break
+            jsTimings.append((cost.jsBytes, time.perf_counter() - startTime))
+
+        pyTimings = []
+        for cost in spreadSample(pyCommits, sampleCount):
+            _, pyDeltas = self.changedSourceFiles(self._repository[cost.commitId])
+            fileEntries = [createFileEntry(self._repository, delta) for delta in pyDeltas]
+
+            startTime = time.perf_counter()
+            formatPYFiles(fileEntries)
+            pyTimings.append((cost.pyBytes, time.perf_counter() - startTime))
+
+        return (jsTimings, pyTimings)
+
+
+def spreadSample(sortedItems, sampleCount):
+    """Evenly spaced items of a sorted list, always including the first and the last one"""
+    if len(sortedItems) <= sampleCount:
+        return list(sortedItems)
+    if sampleCount == 1:
+        return [sortedItems[-1]]
+
+    step = (len(sortedItems) - 1) / (sampleCount - 1)
+    return [sortedItems[round(index * step)] for index in range(sampleCount)]
+
+
+def fitTimeModel(timings):
+    """
+    Least squares fit of seconds = overhead + bytes * secondsPerByte over (bytes, seconds) samples.
+    Falls back to a plain average rate when the sample sizes are too similar to tell both apart.
+    """
+    if not timings:
+        return (0.0, 0.0)
+
+    count = len(timings)
+    meanBytes = sum(size for size, _ in timings) / count
+    meanSeconds = sum(seconds for _, seconds in timings) / count
+    variance = sum((size - meanBytes) ** 2 for size, _ in timings)
+
+    if variance > 0:
+        secondsPerByte = sum((size - meanBytes) * (seconds - meanSeconds) for size, seconds in timings) / variance
+        overhead = meanSeconds - secondsPerByte * meanBytes
+        if secondsPerByte >= 0 and overhead >= 0:
+            return (overhead, secondsPerByte)
+
+    return (0.0, meanSeconds / meanBytes if meanBytes else 0.0)
+
+
+def projectedTime(model, size):
+    overhead, secondsPerByte = model
+    return overhead + secondsPerByte * size if size else 0.0
+
+
+def formatDuration(seconds):
+    return ddhhmmss(int(seconds)) if seconds >= 60 else "{0: >#0.3f}s".format(seconds)
+
+
+def formatBytes(size):
+    return "{0: >#0.1f} MB".format(size / 2**20)
+
+
+def printReport(estimator, jsTimings, pyTimings):
+    costs = estimator.commitCosts
+    jsModel = fitTimeModel(jsTimings or [])
+    pyModel = fitTimeModel(pyTimings)
+
+    def commitTime(cost):
+        return cost.diffTime + projectedTime(jsModel, cost.jsBytes) + projectedTime(pyModel, cost.pyBytes)
+
+    totalJSBytes = sum(cost.jsBytes for cost in costs)
+    totalPYBytes = sum(cost.pyBytes for cost in costs)
+    distinctJSBytes = sum(estimator.distinctJSBlobs.values())
+    distinctPYBytes = sum(estimator.distinctPYBlobs.values())
+
+    print("\n{0} commits to rewrite".format(len(costs)))
+    print("JS: {0} changed files, {1} ({2} distinct blobs, {3})".format(
+        sum(cost.jsFiles for cost in costs), formatBytes(totalJSBytes),
+        len(estimator.distinctJSBlobs), formatBytes(distinctJSBytes))
+    )
+    print("PY: {0} changed files, {1} ({2} distinct blobs, {3})".format(
+        sum(cost.pyFiles for cost in costs), formatBytes(totalPYBytes),
+        len(estimator.distinctPYBlobs), formatBytes(distinctPYBytes))
+    )
+
+    largestJS = max((cost for cost in costs if cost.jsFiles), key=lambda cost: cost.jsBytes, default=None)
+    largestPY = max((cost for cost in costs if cost.pyFiles), key=lambda cost: cost.pyBytes, default=None)
+    if largestJS is not None:
+        print("Peak JS payload: {0} in {1} files ({2})".format(formatBytes(largestJS.jsBytes), largestJS.jsFiles, largestJS.commitId))
+    if largestPY is not None:
+        print("Peak PY payload: {0} in {1} files ({2})".format(formatBytes(largestPY.pyBytes), largestPY.pyFiles, largestPY.commitId))
+
+    if jsTimings is not None:
+        print("JS transform model: {0: >#0.3f}s per commit + {1: >#0.3f}s per MB ({2} samples)".format(
+            jsModel[0], jsModel[1] * 2**20, len(jsTimings))
+        )
+    print("PY format model: {0: >#0.3f}s per commit + {1: >#0.3f}s per MB ({2} samples)".format(
+        pyModel[0], pyModel[1] * 2**20, len(pyTimings))
+    )
+
+    diffTime = sum(cost.diffTime for cost in costs)
+    jsTime = sum(projectedTime(jsModel, cost.jsBytes) for cost in costs)
+    pyTime = sum(projectedTime(pyModel, cost.pyBytes) for cost in costs)
+    # With a warm transform cache, every distinct blob is transformed once
+    jsCachedTime = jsModel[1] * distinctJSBytes + jsModel[0] * sum(1 for cost in costs if cost.jsFiles)
+    pyCachedTime = pyModel[1] * distinctPYBytes + pyModel[0] * sum(1 for cost in costs if cost.pyFiles)
+
+    print("\nProjected time (diffs measured, transforms projected, tree and commit writes not included):")
+    print("  diffs          {0}".format(formatDuration(diffTime)))
+    print("  JS transforms  {0} ({1} if every distinct blob is only transformed once)".format(
+        formatDuration(jsTime), formatDuration(jsCachedTime))
+    )
+    print("  PY formatting  {0} ({1} if every distinct blob is only formatted once)".format(
+        formatDuration(pyTime), formatDuration(pyCachedTime))
+    )
+    print("  total          {0}".format(formatDuration(diffTime + jsTime + pyTime)))
+
+    print("\nSlowest commits:")
+    for cost in sorted(costs, key=commitTime, reverse=True)[:SLOWEST_COMMITS_SHOWN]:
+        print("  {0} {1: >10.1f}s  {2} JS files ({3}), {4} PY files ({5})".format(
+            cost.commitId, commitTime(cost), cost.jsFiles, formatBytes(cost.jsBytes), cost.pyFiles, formatBytes(cost.pyBytes))
+        )
+
+
+def main(sourcePath = SOURCE_REPO_PATH, sampleCount = DEFAULT_SAMPLE_COUNT):
+    sourceRepo = pygit2.Repository(str(sourcePath))
+
+    estimator = CostEstimator(sourceRepo)
+    estimator.analyze()
+
+    print("Timing transforms on up to {0} sample commits each...".format(sampleCount))
+    jsTimings, pyTimings = estimator.timeSampleTransforms(sampleCount)
+
+    printReport(estimator, jsTimings, pyTimings)
+
+if __name__ == "__main__":
+    main(sampleCount=int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SAMPLE_COUNT)
@@ -1,20 +1,55 @@
 const express = require('express')
+const zlib = require("zlib");
+const {promisify} = require("util");
 const {stopwatch} = require("durations");
 
 const workerpool = require('workerpool');
 
+const gzip = promisify(zlib.gzip);
+
 const app = express()
 const port = 4444
 
-// Gotta accept large POSTs
+// Gotta accept large POSTs. Gzipped request bodies are inflated by the JSON parser.
 app.use(express.json({limit: '50mb'}));
 
+// Compact results only carry what the client does not have yet: no source if it did not change (which includes
+// failed files, whose source is returned as it was sent), and the failed source only if asked for
+function compactResult(fileEntry, transformedFile, includeFailedSource) {
+    const {source, failedSource} = transformedFile;
+    const result = {};
+
+    if(source !== fileEntry.source) {
+        result.source = source;
+    }
+    if(failedSource !== undefined) {
+        result.failed = true;
+        if(includeFailedSource) {
+            result.failedSource = failedSource;
+        }
+    }
+    return result;
+}
+
+async function sendJSON(req, res, value) {
+    let body = Buffer.from(JSON.stringify(value));
+
+    res.set("Content-Type", "application/json");
+
+    if(req.acceptsEncodings("gzip")) {
+        body = await gzip(body, {level : zlib.constants.Z_BEST_SPEED});
+        res.set("Content-Encoding", "gzip");
+    }
+
+    res.status(200).send(body);
+}
+
 // Go go multi-core!
 const pool = workerpool.pool(__dirname + '/transformJSFile.js', {minWorkers : 8});
 
 app.post('/', async (req, res) => {
     const {body = {}} = req;
-    const {commitId, files = []} = body;
+    const {commitId, files = [], compact = false, includeFailedSource = false} = body;
 
     const keys = Object.keys(body);
 
@@ -26,10 +61,12 @@ app.post('/', async (req, res) => {
     const totalTime = stopwatch();
     totalTime.start();
 
-    console.log(`Request received.  Processing commit ${commitId}...`)
+    // Coalesced requests carry the files of several commits, each file with its own commit ID
+    const commitCount = new Set(files.map(fileEntry => fileEntry.commitId || commitId)).size;
+    console.log(`Request received.  Processing ${files.length} files of ${commitCount} commit(s) from ${commitId}...`)
 
     const transformedFilePromises = files.map(fileEntry => {
-        return pool.exec("transformJSFile", [commitId, fileEntry]);
+        return pool.exec("transformJSFile", [fileEntry.commitId || commitId, fileEntry]);
     })
 
     const transformedFiles = await Promise.all(transformedFilePromises);
@@ -38,7 +75,18 @@ app.post('/', async (req, res) => {
     const totalElapsed = totalTime.duration().seconds();
     console.log(`Processing complete (${totalElapsed}s)\n`);
 
-    res.status(200).send(transformedFiles);
+    // Lets the client tell transform time and transport overhead apart
+    res.set("X-Transform-Seconds", String(totalElapsed));
+
+    if(!compact) {
+        res.status(200).send(transformedFiles);
+        return;
+    }
+
+    const results = transformedFiles.map((transformedFile, index) => {
+        return compactResult(files[index], transformedFile, includeFailedSource);
+    });
+    await sendJSON(req, res, results);
 
 })
 
@@ -0,0 +1,73 @@
+import os
+import re
+
+from plumbum import local
+from plumbum.commands import ProcessExecutionError
+
+
+# Commits written between two packings of the loose objects
+PACK_INTERVAL = 500
+
+LOOSE_OBJECT_DIRECTORY = re.compile("^[0-9a-f]{2}$")
+LOOSE_OBJECT_NAME = re.compile("^[0-9a-f]{38}$")
+
+
+class ObjectPacker:
+    """
+    Keeps the objects a rewrite writes in pack files instead of letting millions of loose objects pile up.
+
+    pygit2 has no in-memory ODB backend to buffer new objects in, so they are still written loose, but every
+    `interval` commits the loose objects are moved into a new pack. Rewritten commits are not referenced by any ref
+    until the very end, so this uses git pack-objects on the loose object list rather than git repack, which only packs
+    reachable objects. At the end the packs are consolidated, so the output repo is compact without a separate git gc.
+
+    libgit2 rescans the pack directory when it misses an object, so packing while the repository is open is safe.
+    """
+
+    def __init__(self, repositoryPath, interval = PACK_INTERVAL):
+        self._objectsPath = os.path.join(str(repositoryPath), "objects")
+        self._git = local["git"]["--git-dir", str(repositoryPath)]
+        self._interval = interval
+        self._commitsSinceRepack = 0
+        self.packCount = 0
+
+    def commitWritten(self):
+        self._commitsSinceRepack += 1
+        if self._commitsSinceRepack >= self._interval:
+            self.packLooseObjects()
+
+    def packLooseObjects(self):
+        self._commitsSinceRepack = 0
+        objectIds = self._looseObjectIds()
+        if not objectIds:
+            return
+
+        packPrefix = os.path.join(self._objectsPath, "pack", "pack")
+        # pack-objects sorts the objects by type and size to find deltas
+        (self._git["pack-objects", "-q", packPrefix] << "\n".join(objectIds) + "\n")()
+        # Only deletes loose objects that are now in a pack; anything written meanwhile stays
+        self._git("prune-packed", "-q")
+        self.packCount += 1
+
+    def finish(self):
+        """
+        Packs the remaining loose objects and merges the packs written along the way
+        """
+        self.packLooseObjects()
+        try:
+            # Merges packs into a geometric progression of sizes, cheaper than rewriting every pack (git 2.33+).
+            # -l leaves the objects of an alternate object database out.
+            self._git("repack", "-d", "-l", "-q", "--geometric=2")
+        except ProcessExecutionError:
+            # Older git: the packs stay as they are, the repository is usable either way
+            pass
+
+    def _looseObjectIds(self):
+        objectIds = []
+        for directoryName in os.listdir(self._objectsPath):
+            if not LOOSE_OBJECT_DIRECTORY.match(directoryName):
+                continue
+            for fileName in os.listdir(os.path.join(self._objectsPath, directoryName)):
+                if LOOSE_OBJECT_NAME.match(fileName):
+                    objectIds.append(directoryName + fileName)
+        return objectIds
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only on-disk journal of rewritten commits, used to resume interrupted rewrites
+"""
+
+import os
+
+from pygit2 import Repository, Oid
+
+
+class CommitJournal:
+    """
+    Every line maps an original commit to its rewritten counterpart:
+        <original SHA1> <rewritten SHA1> [<rewritten SHA1> ...]
+    A single rewritten SHA1 is a regular rewrite, any other count is a skipped commit that was replaced by
+    its parents. Lines are buffered and made durable every `checkpoint_interval` commits.
+    """
+
+    def __init__(self, path: str, checkpoint_interval: int = 100):
+        self.path = path
+        self._checkpoint_interval = checkpoint_interval
+        self._pending = 0
+        self._file = None
+
+    def load(self, repository: Repository):
+        """
+        Reads the journal back. Replay stops at the first torn line or at the first entry whose rewritten commit
+        did not make it to the repository, and the journal is truncated there.
+        :return: list of (original Oid, rewritten Oid or list of Oids) in journal order
+        """
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+
+        durable_size = 0
+        with open(self.path, 'rb') as journal_file:
+            for line in journal_file:
+                entry = self._parse_line(line)
+                if entry is None or not self._is_durable(repository, entry[1]):
+                    break
+                entries.append(entry)
+                durable_size += len(line)
+
+        if durable_size != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as journal_file:
+                journal_file.truncate(durable_size)
+
+        return entries
+
+    @staticmethod
+    def _parse_line(line: bytes):
+        if not line.endswith(b'\n'):
+            return None
+
+        ids = line.split()
+        if not ids or any(len(entry) != 40 for entry in ids):
+            return None
+
+        try:
+            original = Oid(hex=ids[0].decode('ascii'))
+            rewritten = [Oid(hex=entry.decode('ascii')) for entry in ids[1:]]
+        except ValueError:
+            return None
+
+        if len(rewritten) == 1:
+            return original, rewritten[0]
+        return original, rewritten
+
+    @staticmethod
+    def _is_durable(repository: Repository, rewritten):
+        if not isinstance(rewritten, Oid):
+            return all(parent in repository for parent in rewritten)
+        if rewritten not in repository:
+            return False
+        return repository[rewritten].tree_id in repository
+
+    def append(self, original: Oid, rewritten):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+
+        if isinstance(rewritten, Oid):
+            rewritten = [rewritten]
+        line = ' '.join([original.hex] + [entry.hex for entry in rewritten]) + '\n'
+        self._file.write(line.encode('ascii'))
+
+        self._pending += 1
+        if self._pending >= self._checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if self._file is None:
+            return
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        self.checkpoint()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory lookup of full commit ids from abbreviated SHA1s
+"""
+
+from bisect import bisect_left
+
+from pygit2 import Oid
+
+
+class CommitPrefixIndex:
+    """
+    Sorted array of hex commit ids. An abbreviated id resolves with a single binary search, instead of a
+    repository lookup per candidate.
+    """
+
+    def __init__(self, commit_ids=()):
+        self._hex_ids = sorted(set(commit_id.hex for commit_id in commit_ids))
+
+    def __len__(self):
+        return len(self._hex_ids)
+
+    def resolve(self, prefix: str):
+        """
+        :return: Oid of the only indexed commit starting with prefix, None if there is none or several
+        """
+        prefix = prefix.lower()
+        hex_ids = self._hex_ids
+        position = bisect_left(hex_ids, prefix)
+        if position == len(hex_ids) or not hex_ids[position].startswith(prefix):
+            return None
+        if position + 1 < len(hex_ids) and hex_ids[position + 1].startswith(prefix):
+            return None
+        return Oid(hex=hex_ids[position])
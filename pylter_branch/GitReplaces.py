@@ -7,28 +7,26 @@ class GitReplaces:
     def __init__(self, repository: Repository):
         assert (isinstance(repository, Repository))
         self._repository = repository
-        self._replaces = {}
+        self.replaces = {}
         self._read_replaces()
 
     def _read_replaces(self):
         prefix = 'refs/replace/'
         prefix_len = len(prefix)
 
-        for ref in self._repository.references:
+        # read once; lookups during loading go straight to the dict
+        for ref in self._repository.listall_references():
             if ref.startswith(prefix):
-                self._replaces[ Oid(hex=ref[prefix_len:]) ] = self._repository.references[ref].target
+                self.replaces[ Oid(hex=ref[prefix_len:]) ] = self._repository.references[ref].target
 
     def __getitem__(self, item):
         if not isinstance(item, Oid):
             item = Oid(hex=item)
 
-        try:
-            return self._replaces[item]
-        except KeyError:
-            return item
+        return self.replaces.get(item, item)
 
     def __iter__(self):
-        return iter(self._replaces)
+        return iter(self.replaces)
 
     def __len__(self):
-        return len(self._replaces)
+        return len(self.replaces)
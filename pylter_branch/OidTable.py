@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Compact containers keyed by object ids. Keys are kept as raw 20-byte SHA1s in open-addressing hash tables backed by
+a single bytearray, instead of one Python Oid object (plus a dict or set slot) per entry.
+"""
+
+from pygit2 import Oid
+
+_OID_SIZE = 20
+_EMPTY_KEY = bytes(_OID_SIZE)
+# value slot marker for values that are not a single Oid, e.g. the parents list of a skipped commit
+_INDIRECT_VALUE = b'\xff' * _OID_SIZE
+_INITIAL_CAPACITY = 1024
+# Between 1/2 and 3/4 of the slots are in use; linear probing over uniformly distributed keys stays short there
+_MAX_LOAD = 0.75
+_GROWTH_FACTOR = 1.5
+
+
+def _raw(oid):
+    if isinstance(oid, Oid):
+        return oid.raw
+    if isinstance(oid, str):
+        return Oid(hex=oid).raw
+    return bytes(oid)
+
+
+class _OidHashTable:
+    """
+    Linear probing over 20-byte slots, kept at most 3/4 full.
+    SHA1s are uniformly distributed, so their first bytes are used as the hash directly.
+    The all-zero id marks an empty slot; it is never the id of a real object.
+    """
+
+    def __init__(self, value_size=0):
+        self._value_size = value_size
+        self._size = 0
+        self._allocate(_INITIAL_CAPACITY)
+
+    def _allocate(self, capacity):
+        self._capacity = capacity
+        self._max_size = int(capacity * _MAX_LOAD)
+        self._keys = bytearray(capacity * _OID_SIZE)
+        self._values = bytearray(capacity * self._value_size)
+
+    def _find_slot(self, raw):
+        """
+        :return: slot holding raw, or the empty slot where it would be inserted
+        """
+        keys = self._keys
+        capacity = self._capacity
+        slot = int.from_bytes(raw[:8], 'little') % capacity
+        while True:
+            offset = slot * _OID_SIZE
+            stored = keys[offset:offset + _OID_SIZE]
+            if stored == raw or stored == _EMPTY_KEY:
+                return slot
+            slot += 1
+            if slot == capacity:
+                slot = 0
+
+    def _contains_raw(self, raw):
+        return self._keys.startswith(raw, self._find_slot(raw) * _OID_SIZE)
+
+    def _insert_raw(self, raw, value=b''):
+        """
+        :return: True when raw was not in the table yet
+        """
+        slot = self._find_slot(raw)
+        offset = slot * _OID_SIZE
+        is_new = not self._keys.startswith(raw, offset)
+        if is_new:
+            self._keys[offset:offset + _OID_SIZE] = raw
+            self._size += 1
+
+        if self._value_size:
+            value_offset = slot * self._value_size
+            self._values[value_offset:value_offset + self._value_size] = value
+
+        if is_new and self._size > self._max_size:
+            self._grow()
+        return is_new
+
+    def _value_raw(self, raw):
+        slot = self._find_slot(raw)
+        if not self._keys.startswith(raw, slot * _OID_SIZE):
+            return None
+        value_offset = slot * self._value_size
+        return bytes(self._values[value_offset:value_offset + self._value_size])
+
+    def _iter_slots(self):
+        keys = self._keys
+        for slot in range(self._capacity):
+            offset = slot * _OID_SIZE
+            raw = keys[offset:offset + _OID_SIZE]
+            if raw != _EMPTY_KEY:
+                yield slot, bytes(raw)
+
+    def _grow(self):
+        old_keys, old_values, old_capacity = self._keys, self._values, self._capacity
+        self._allocate(int(old_capacity * _GROWTH_FACTOR))
+
+        value_size = self._value_size
+        for old_slot in range(old_capacity):
+            offset = old_slot * _OID_SIZE
+            raw = bytes(old_keys[offset:offset + _OID_SIZE])
+            if raw == _EMPTY_KEY:
+                continue
+
+            slot = self._find_slot(raw)
+            self._keys[slot * _OID_SIZE:(slot + 1) * _OID_SIZE] = raw
+            if value_size:
+                self._values[slot * value_size:(slot + 1) * value_size] = \
+                    old_values[old_slot * value_size:(old_slot + 1) * value_size]
+
+    def __len__(self):
+        return self._size
+
+    def memory_size(self):
+        return len(self._keys) + len(self._values)
+
+
+class OidSet(_OidHashTable):
+    """
+    Set of object ids, supporting the operations RepositoryProcessor uses on its known objects
+    """
+
+    def __init__(self, oids=()):
+        super().__init__()
+        for oid in oids:
+            self.add(oid)
+
+    def __contains__(self, oid):
+        return self._contains_raw(_raw(oid))
+
+    def __iter__(self):
+        for _, raw in self._iter_slots():
+            yield Oid(raw=raw)
+
+    def add(self, oid):
+        self._insert_raw(_raw(oid))
+
+
+class OidMap(_OidHashTable):
+    """
+    Mapping of object ids to object ids, e.g. original to rewritten commits.
+    Values that are not a single Oid (lists of parents of skipped commits) live in a regular side dict.
+    """
+
+    def __init__(self, items=()):
+        super().__init__(value_size=_OID_SIZE)
+        self._indirect_values = {}
+        for key, value in dict(items).items():
+            self[key] = value
+
+    def __contains__(self, oid):
+        return self._contains_raw(_raw(oid))
+
+    def __getitem__(self, oid):
+        raw = _raw(oid)
+        value = self._value_raw(raw)
+        if value is None:
+            raise KeyError(oid)
+        if value == _INDIRECT_VALUE:
+            return self._indirect_values[raw]
+        return Oid(raw=value)
+
+    def __setitem__(self, oid, value):
+        raw = _raw(oid)
+        if isinstance(value, Oid):
+            self._indirect_values.pop(raw, None)
+            self._insert_raw(raw, value.raw)
+        else:
+            self._indirect_values[raw] = value
+            self._insert_raw(raw, _INDIRECT_VALUE)
+
+    def __iter__(self):
+        return self.keys()
+
+    def get(self, oid, default=None):
+        try:
+            return self[oid]
+        except KeyError:
+            return default
+
+    def keys(self):
+        for _, raw in self._iter_slots():
+            yield Oid(raw=raw)
+
+    def items(self):
+        for _, raw in self._iter_slots():
+            yield Oid(raw=raw), self[raw]
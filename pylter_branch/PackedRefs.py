@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Batched reference updates, written as a single packed-refs file
+"""
+
+import os
+
+import pygit2
+from pygit2 import Repository, Oid
+
+PACKED_REFS_HEADER = '# pack-refs with: peeled sorted \n'
+TAGS_PREFIX = 'refs/tags/'
+
+
+class PackedRefs:
+    """
+    Snapshot of all direct references of a repository that can be edited in memory and written back at once.
+    write() replaces packed-refs with a single rename, then drops the loose files of every packed reference, so
+    after the first write later writes are atomic. Symbolic references are left alone.
+    """
+
+    def __init__(self, repository: Repository):
+        self._repository = repository
+        self._targets = {}
+        self._loose_names = set()
+
+        for ref_name in repository.references:
+            ref = repository.references[ref_name]
+            if ref.type == pygit2.GIT_REF_SYMBOLIC:
+                continue
+            self._targets[ref_name] = ref.target
+            self._loose_names.add(ref_name)
+
+    def __contains__(self, ref_name):
+        return ref_name in self._targets
+
+    def __getitem__(self, ref_name):
+        return self._targets[ref_name]
+
+    def __setitem__(self, ref_name, target: Oid):
+        self._targets[ref_name] = target
+
+    def __delitem__(self, ref_name):
+        del self._targets[ref_name]
+
+    def items(self):
+        return list(self._targets.items())
+
+    def _peeled(self, ref_name, target):
+        if not ref_name.startswith(TAGS_PREFIX):
+            return None
+
+        obj = self._repository[target]
+        if not isinstance(obj, pygit2.Tag):
+            return None
+        while isinstance(obj, pygit2.Tag):
+            obj = self._repository[obj.target]
+        return obj.id
+
+    def _format(self):
+        lines = [PACKED_REFS_HEADER]
+        for ref_name in sorted(self._targets, key=lambda name: name.encode('utf-8')):
+            target = self._targets[ref_name]
+            lines.append('{0} {1}\n'.format(target.hex, ref_name))
+            peeled = self._peeled(ref_name, target)
+            if peeled is not None:
+                lines.append('^{0}\n'.format(peeled.hex))
+        return ''.join(lines).encode('utf-8')
+
+    def write(self):
+        git_dir = self._repository.path
+        packed_refs_path = os.path.join(git_dir, 'packed-refs')
+        lock_path = packed_refs_path + '.lock'
+
+        # same lock protocol as git itself: fails if someone else is updating packed-refs
+        lock_fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            os.write(lock_fd, self._format())
+            os.fsync(lock_fd)
+        except BaseException:
+            os.close(lock_fd)
+            os.remove(lock_path)
+            raise
+        os.close(lock_fd)
+        os.replace(lock_path, packed_refs_path)
+
+        # loose files take precedence over packed-refs, they have to go
+        for ref_name in self._loose_names:
+            try:
+                os.remove(os.path.join(git_dir, ref_name))
+            except FileNotFoundError:
+                pass
+        self._loose_names = set()
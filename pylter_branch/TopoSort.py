@@ -1,42 +1,108 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+from array import array
+from collections import deque
 
 
 class TopoSort:
+    """
+    DAG with dense integer vertex ids. Edges are appended to two flat arrays and only turned into
+    compressed adjacency lists when sorting, so the graph costs a few machine words per edge.
+    Weak edges order their vertices like regular ones, unless they would close a cycle, in which case they are
+    ignored.
+    """
+
     def __init__(self):
-        self.vertices = set()
-        self.edges = defaultdict(set)
+        self.vertices = []
+        self._vertex_ids = {}
+        self._sources = array('q')
+        self._destinations = array('q')
+        self._weak_edge_count = 0
+
+    def _vertex_id(self, vertex):
+        vertex_id = self._vertex_ids.get(vertex)
+        if vertex_id is None:
+            vertex_id = len(self.vertices)
+            self._vertex_ids[vertex] = vertex_id
+            self.vertices.append(vertex)
+        return vertex_id
 
     def add_edge(self, source, destination):
-        self.add_vertex(source)
-        self.add_vertex(destination)
-        self.edges[source].add(destination)
+        self._sources.append(self._vertex_id(source))
+        self._destinations.append(self._vertex_id(destination))
+
+    def add_weak_edge(self, source, destination):
+        self.add_edge(source, destination)
+        # stored as the bitwise complement of the source, always negative
+        self._sources[-1] = ~self._sources[-1]
+        self._weak_edge_count += 1
 
     def add_vertex(self, vertex):
-        self.vertices.add(vertex)
+        self._vertex_id(vertex)
 
     def sort(self):
-        ingrees = { v : 0 for v in self.vertices }
-        for neighbours in self.edges.values():
-            for u in neighbours:
-                ingrees[u] += 1
+        vertex_count = len(self.vertices)
+        edge_count = len(self._sources)
 
-        non_processed = self.vertices.copy()
-        queue = [ v for v, ingree in ingrees.items() if ingree == 0 ]
+        # compressed sparse rows: neighbours of u are targets[offsets[u]:offsets[u + 1]]
+        offsets = array('q', bytes(8 * (vertex_count + 1)))
+        for source in self._sources:
+            offsets[(source if source >= 0 else ~source) + 1] += 1
+        for vertex_id in range(vertex_count):
+            offsets[vertex_id + 1] += offsets[vertex_id]
+
+        # weak edge targets are stored complemented as well
+        targets = array('q', bytes(8 * edge_count))
+        ingrees = array('q', bytes(8 * vertex_count))
+        weak_ingrees = array('q', bytes(8 * vertex_count)) if self._weak_edge_count else None
+        next_slot = offsets[:-1]
+        for source, destination in zip(self._sources, self._destinations):
+            if source < 0:
+                source = ~source
+                weak_ingrees[destination] += 1
+                targets[next_slot[source]] = ~destination
+            else:
+                targets[next_slot[source]] = destination
+            next_slot[source] += 1
+            ingrees[destination] += 1
+
+        queue = deque(vertex_id for vertex_id in range(vertex_count) if ingrees[vertex_id] == 0)
         topo_order = []
+        # Blocked vertices only waiting for weak edges. Once a vertex is in there it stays so, until it is emitted
+        weak_only = deque()
+        if weak_ingrees is not None:
+            weak_only.extend(vertex_id for vertex_id in range(vertex_count)
+                             if 0 < ingrees[vertex_id] == weak_ingrees[vertex_id])
+
+        while True:
+            while queue:
+                u = queue.popleft()
+                topo_order.append(self.vertices[u])
+                for edge in range(offsets[u], offsets[u + 1]):
+                    v = targets[edge]
+                    if v < 0:
+                        v = ~v
+                        weak_ingrees[v] -= 1
+                        ingrees[v] -= 1
+                    else:
+                        ingrees[v] -= 1
+                        if weak_ingrees is not None and 0 < ingrees[v] == weak_ingrees[v]:
+                            weak_only.append(v)
+                    if ingrees[v] == 0:
+                        queue.append(v)
 
-        while queue:
-            u = queue.pop(0)
-            topo_order.append(u)
-            neighbours = self.edges[u]
-            for v in neighbours:
-                ingrees[v] -= 1
-                if ingrees[v] == 0:
+            # Stuck on a cycle. A vertex only waiting for weak edges is released, ignoring those edges; the
+            # regular edges alone are acyclic, so there is always one. Marked -1 so it is not queued again.
+            while weak_only:
+                v = weak_only.popleft()
+                if ingrees[v] > 0:
+                    ingrees[v] = -1
                     queue.append(v)
-            non_processed.remove(u)
+                    break
+            if not queue:
+                break
 
-        if len(non_processed):
+        if len(topo_order) != vertex_count:
             raise RuntimeError("Cycles are in graph")
 
         return topo_order
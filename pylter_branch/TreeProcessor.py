@@ -1,66 +1,107 @@
 # -*- coding: utf-8 -*-
 
+from collections import namedtuple
+
 import pygit2
 
 PATH_SEPARATOR = '/'
 
 
+class FileEntry(namedtuple('FileEntry', ['hex', 'filemode'])):
+    """
+    Tree entry for TreeWrapper.insert that does not come from a git tree, e.g. a blob that was just written
+    """
+    __slots__ = ()
+    type = pygit2.GIT_OBJ_BLOB
+
+
 class TreeWrapper:
     @classmethod
     def is_tree(cls, entry):
         if isinstance(entry, cls):
             return True
         if hasattr(entry, 'type'):
-            return entry.type == 'tree'
+            return entry.type == pygit2.GIT_OBJ_TREE
         return False
 
     @classmethod
     def is_git_tree(_, entry):
-        return hasattr(entry, 'type') and entry.type == 'tree'
+        return hasattr(entry, 'type') and entry.type == pygit2.GIT_OBJ_TREE
+
+    # A node per touched directory: no __dict__, and the edit dicts only exist once something is looked up or changed
+    __slots__ = ('_repository', '_tree', '_children', '_changes')
 
     def __init__(self, repository: pygit2.Repository, tree: pygit2.Tree):
+        # shared by all nodes of the tree
         self._repository = repository
+        # original git tree, None for a directory that did not exist
         self._tree = tree
-        self._raw_data = {}
+        # wrapped subdirectories of _tree handed out so far, they may be edited in place
+        self._children = None
+        # name -> entry inserted since the last save, None for a removed name
+        self._changes = None
 
     def __contains__(self, item):
-        return (self._tree and (item in self._tree)) or (item in self._raw_data)
+        if self._changes and item in self._changes:
+            return self._changes[item] is not None
+        return self._tree is not None and item in self._tree
 
     def __getitem__(self, item):
-        if self._tree:
-            return self._wrap_git_entry(self._tree[item])
-        else:
-            return self._raw_data[item]
+        if self._changes and item in self._changes:
+            entry = self._changes[item]
+            if entry is None:
+                raise KeyError(item)
+            return entry
+
+        if self._children:
+            child = self._children.get(item)
+            if child is not None:
+                return child
+        if self._tree is None:
+            raise KeyError(item)
+
+        entry = self._wrap_git_entry(self._tree[item])
+        if isinstance(entry, TreeWrapper):
+            if self._children is None:
+                self._children = {}
+            self._children[item] = entry
+        return entry
 
     def _wrap_git_entry(self, entry):
         if TreeWrapper.is_git_tree(entry):
             try:
-                return TreeWrapper(self._repository, self._repository[entry.id])
+                return type(self)(self._repository, self._repository[entry.id])
             except pygit2.GitError:
                 return entry
         else:
             return entry
 
-    def _unfold(self):
-        if self._tree is None:
-            return
-
-        assert (not self._raw_data)
-        for entry in self._tree:
-            self._raw_data[entry.name] = self._wrap_git_entry(entry)
-
-        self._tree = None
+    def _items(self):
+        changes = self._changes or {}
+        if self._tree is not None:
+            for entry in self._tree:
+                if entry.name not in changes:
+                    yield entry.name, self[entry.name]
+        for name, entry in changes.items():
+            if entry is not None:
+                yield name, entry
 
     def _insert(self, name, entry):
-        self._unfold()
         if TreeWrapper.is_git_tree(entry):
             entry = self._wrap_git_entry(entry)
-        self._raw_data[name] = entry
+        if self._children:
+            self._children.pop(name, None)
+        if self._changes is None:
+            self._changes = {}
+        self._changes[name] = entry
 
     def _rm(self, name):
         if name in self:
-            self._unfold()
-            del self._raw_data[name]
+            if self._children:
+                self._children.pop(name, None)
+            if self._changes is None:
+                self._changes = {}
+            self._changes[name] = None
             return True
         return False
 
@@ -72,11 +113,9 @@ class TreeWrapper:
 
     def _merge_tree(self, rhs):
         assert isinstance(rhs, TreeWrapper)
-        self._unfold()
-        rhs._unfold()
-        for name, entry in rhs._raw_data.items():
+        for name, entry in list(rhs._items()):
             if name in self:
-                own = self._raw_data[name]
+                own = self[name]
                 if own == entry:
                     continue
                 elif isinstance(own, TreeWrapper) and isinstance(entry, TreeWrapper):
@@ -89,13 +128,21 @@ class TreeWrapper:
                 self._insert(name, entry)
 
     def is_dirty(self):
-        return bool(self._raw_data) and self._tree is None
+        if self._changes or self._tree is None:
+            return True
+        return bool(self._children) and any(child.is_dirty() for child in self._children.values())
 
     def is_empty(self):
-        return len(self._raw_data) == 0 and self._tree is None
+        # counts names without wrapping any subdirectory
+        changes = self._changes or {}
+        if any(entry is not None for entry in changes.values()):
+            return False
+        if self._tree is None:
+            return True
+        return all(entry.name in changes for entry in self._tree)
 
     def hex(self):
-        if self._tree is None:
+        if self.is_dirty():
             self.save()
         if self._tree is not None:
             return self._tree.hex
@@ -103,18 +150,36 @@ class TreeWrapper:
             return '0'*40
 
     def save(self):
-        if self._tree:
+        """
+        Writes the changed subdirectories and this directory on top of the original tree. Untouched entries keep
+        their ids without being read, so the cost grows with the number of changed paths, not directory sizes.
+        """
+        if not self.is_dirty():
             return
 
-        builder = self._repository.TreeBuilder()
-        for name, entry in self._raw_data.items():
-            if isinstance(entry, TreeWrapper):
+        if self._tree is None:
+            builder = self._repository.TreeBuilder()
+        else:
+            builder = self._repository.TreeBuilder(self._tree)
+
+        for name, child in (self._children or {}).items():
+            if child.is_dirty():
+                builder.insert(name, child.hex(), pygit2.GIT_FILEMODE_TREE)
+
+        for name, entry in (self._changes or {}).items():
+            if entry is None:
+                if self._tree is not None and name in self._tree:
+                    builder.remove(name)
+            elif isinstance(entry, TreeWrapper):
                 builder.insert(name, entry.hex(), pygit2.GIT_FILEMODE_TREE)
+                if self._children is None:
+                    self._children = {}
+                self._children[name] = entry
             else:
                 builder.insert(name, entry.hex, entry.filemode)
 
         self._tree = self._repository[builder.write()]
-        self._raw_data = {}
+        self._changes = None
 
     def get(self, path, default=None):
         path_parts = path.split(PATH_SEPARATOR, 1)
@@ -147,7 +212,6 @@ class TreeWrapper:
             if child.is_empty():
                 return self._rm(immediate)
             else:
-                # force unfolding
                 self._insert(immediate, child)
             return True
 
@@ -160,7 +224,9 @@ class TreeWrapper:
             return
 
         immediate, rest = path_parts
-        child = self._get(immediate, TreeWrapper(self._repository, None))
+        child = self._get(immediate)
+        if child is None:
+            child = type(self)(self._repository, None)
         if not isinstance(child, TreeWrapper):
             raise RuntimeError("Tree expected. Something else found")
         child.insert(rest, entry)
@@ -182,3 +248,69 @@ class TreeWrapper:
         else:
             raise RuntimeError("Incompatible types at source and destination")
         self.rm(old_path)
+
+    def apply(self, operations):
+        """
+        Applies many path operations in one pass over the tree, with the same result as calling the per-path
+        methods in order. Operations are (op, path, entry) tuples where op is 'insert' or 'rm', or
+        ('mv', old_path, new_path). Paths are split once and grouped by directory, so each touched directory is
+        walked once per batch instead of once per path. A mv touches two places of the tree and ends the batch.
+        A path going through a file raises RuntimeError like the per-path methods, but the operations applied
+        before it may differ.
+        """
+        batch = []
+        for op, path, entry in operations:
+            if op == 'mv':
+                self._apply_batch(batch)
+                batch = []
+                self.mv(path, entry)
+            elif op in ('insert', 'rm'):
+                batch.append((op, path.split(PATH_SEPARATOR), 0, entry))
+            else:
+                raise ValueError("Unknown tree operation: " + op)
+        self._apply_batch(batch)
+
+    def _apply_batch(self, operations):
+        # operations on the same name keep their order, different names are independent
+        by_name = {}
+        for operation in operations:
+            op, path_parts, depth, entry = operation
+            by_name.setdefault(path_parts[depth], []).append(operation)
+
+        for name, name_operations in by_name.items():
+            nested = []
+            for operation in name_operations:
+                op, path_parts, depth, entry = operation
+                if depth + 1 < len(path_parts):
+                    nested.append((op, path_parts, depth + 1, entry))
+                    continue
+
+                self._apply_nested(name, nested)
+                nested = []
+                if op == 'insert':
+                    self._insert(name, entry)
+                else:
+                    self._rm(name)
+            self._apply_nested(name, nested)
+
+    def _apply_nested(self, name, operations):
+        if not operations:
+            return
+
+        child = self._get(name)
+        if child is None:
+            if all(op == 'rm' for op, _, _, _ in operations):
+                return
+            child = type(self)(self._repository, None)
+        elif not isinstance(child, TreeWrapper):
+            if operations[0][0] == 'rm':
+                raise RuntimeError("Could not get tree")
+            raise RuntimeError("Tree expected. Something else found")
+
+        child._apply_batch(operations)
+        if not child.is_dirty():
+            return
+        if child.is_empty():
+            self._rm(name)
+        else:
+            self._insert(name, child)
@@ -2,92 +2,256 @@
 
 
 import re
+import time
+import itertools
 import pygit2
 
+from . import CommitJournal
+from . import CommitPrefixIndex
 from . import GitGrafts
 from . import GitReplaces
+from . import OidTable
+from . import PackedRefs
 from . import TopoSort
 from . import TreeProcessor
 
 
 class RepositoryProcessor:
-    sha1regex = re.compile('([0-9a-fA-F]{8,40})')
+    sha1regex = re.compile(r'\b([0-9a-fA-F]{7,40})\b')
 
-    def __init__(self, repository: pygit2.Repository, replaced_commits=None, known_objects=None):
+    def __init__(self, repository: pygit2.Repository, replaced_commits=None, known_objects=None,
+                 journal: CommitJournal.CommitJournal = None, ref_staging_namespace: str = None,
+                 rewrite_commit_references: bool = False):
         self._repository = repository
         self._grafts = GitGrafts.GitGrafts(self._repository)
         self._replaces = GitReplaces.GitReplaces(self._repository)
-        self.replaced_commits = {} if replaced_commits is None else replaced_commits
-        self._known_objects = set() if known_objects is None else known_objects
+        self.replaced_commits = OidTable.OidMap() if replaced_commits is None else replaced_commits
+        self._known_objects = OidTable.OidSet() if known_objects is None else known_objects
+        # commit -> parents after grafts and replacements, a single Oid or a tuple for root and merge commits
+        self._effective_parents = OidTable.OidMap()
+        self._journal = journal
+        self._ref_staging_namespace = ref_staging_namespace
+        self._rewrite_commit_references = rewrite_commit_references
+        self._commit_prefix_index = None
+        # (commit, SHA1 candidates in its message) while loading with rewrite_commit_references
+        self._message_references = []
+        self.load_time = 0.0
+        self.skipped_objects = 0
+
+    def load(self):
+        """
+        Replays the journal, if any, and loads the commit graph. No commit is written.
+        :return: all loaded commits, parents first
+        """
+        self._replay_journal()
 
-    def process(self):
-        # Loading
         sorter = TopoSort.TopoSort()
         self.on_begin_load()
-        for object_key in self._repository:
-            if object_key in self._known_objects:
-                continue
-
-            self._known_objects.add(object_key)
-
-            try:
-                obj = self._repository[object_key]
-            except MemoryError:
-                self.on_memory_error(object_key)
-                continue
-
-            if obj.type == pygit2.GIT_OBJ_COMMIT:
-                commit = obj.peel(pygit2.Commit)
-                self._read_commit(commit, sorter)
-                self.on_commit_loaded(object_key)
-
+        load_start = time.time()
+        loaded_commits = self._load_commits(sorter)
+        self.load_time = time.time() - load_start
+        self.skipped_objects = self._count_objects() - loaded_commits
+        if self._rewrite_commit_references:
+            self._commit_prefix_index = CommitPrefixIndex.CommitPrefixIndex(
+                itertools.chain(self.replaced_commits.keys(), sorter.vertices))
+            self._order_referenced_commits(sorter)
         self.on_end_load()
         queue = sorter.sort()
         queue.reverse()
+        return queue
+
+    def process(self):
+        queue = self.load()
+
         # Processing
+        self.on_commits_queued([commit_id for commit_id in queue if commit_id not in self.replaced_commits])
         self.on_begin_processing()
-        for commit_id in queue:
-            self._process_commit(commit_id)
+        try:
+            for commit_id in queue:
+                self._process_commit(commit_id)
+        finally:
+            # whatever was rewritten before a crash or Ctrl-C stays resumable
+            if self._journal is not None:
+                self._journal.close()
 
         self.on_end_processing()
 
         # Rewriting refs
-        for ref_name in self._repository.references:
-            ref = self._repository.references[ref_name]
-            if ref.type == pygit2.GIT_REF_SYMBOLIC:
+        self._rewrite_refs()
+
+    def _rewrite_refs(self):
+        """
+        Points every reference at its rewritten commit, recreating annotated tags, and writes them all at once.
+        With a staging namespace the rewritten refs are first stored next to the original ones, and then swapped
+        in by a single atomic packed-refs write.
+        """
+        packed_refs = PackedRefs.PackedRefs(self._repository)
+        namespace = self._ref_staging_namespace
+
+        rewritten_refs = {}
+        for ref_name, target_id in packed_refs.items():
+            if namespace and ref_name.startswith(namespace):
+                # leftover of an interrupted swap, staged again below
+                del packed_refs[ref_name]
                 continue
 
-            target = self._repository[ref.target]
+            target = self._repository[target_id]
             if isinstance(target, pygit2.Tag):
                 commit_id = self.replaced_commits[target.target]
-                ref.delete()
-                tag_id = self._repository.create_tag(target.name, commit_id, target.get_object().type, target.tagger,
-                                                     target.message)
+                rewritten_refs[ref_name] = self._write_tag(target, commit_id)
             else:
-                ref.set_target(self.replaced_commits[ref.target])
+                rewritten_refs[ref_name] = self.replaced_commits[target_id]
+
+        if namespace:
+            staged_names = {ref_name: namespace + ref_name[len('refs/'):] for ref_name in rewritten_refs}
+            for ref_name, new_target in rewritten_refs.items():
+                packed_refs[staged_names[ref_name]] = new_target
+            packed_refs.write()
+
+            for ref_name, staged_name in staged_names.items():
+                del packed_refs[staged_name]
+        for ref_name, new_target in rewritten_refs.items():
+            packed_refs[ref_name] = new_target
+        packed_refs.write()
+
+    def _write_tag(self, tag: pygit2.Tag, commit_id: pygit2.Oid):
+        """
+        Writes a copy of an annotated tag pointing to commit_id, without touching any reference
+        """
+        lines = [b'object ' + commit_id.hex.encode('ascii'),
+                 b'type commit',
+                 b'tag ' + tag.name.encode('utf-8')]
+        if tag.tagger is not None:
+            lines.append(b'tagger ' + self._format_signature(tag.tagger))
+
+        data = b'\n'.join(lines) + b'\n\n' + tag.message.encode('utf-8')
+        return self._repository.write(pygit2.GIT_OBJ_TAG, data)
+
+    @staticmethod
+    def _format_signature(signature: pygit2.Signature):
+        offset = abs(signature.offset)
+        sign = b'-' if signature.offset < 0 else b'+'
+        return b'%s <%s> %d %s%02d%02d' % (signature.raw_name, signature.raw_email, signature.time, sign,
+                                          offset // 60, offset % 60)
+
+    def _replay_journal(self):
+        """
+        Restores commits rewritten by a previous, possibly interrupted, run so they are neither loaded nor
+        processed again
+        """
+        if self._journal is None:
+            return
+
+        entries = self._journal.load(self._repository)
+        for original, rewritten in entries:
+            self._remember_commit(original, rewritten)
+            self._known_objects.add(original)
+        self.on_journal_replayed(len(entries))
+
+    def _load_roots(self):
+        """
+        Commit ids the loading revwalk starts from: targets of all direct references (annotated tags are peeled),
+        plus grafted parents and replacement commits, which may not be reachable through regular parent links.
+        """
+        roots = []
+        for ref_name in self._repository.references:
+            ref = self._repository.references[ref_name]
+            if ref.type == pygit2.GIT_REF_SYMBOLIC:
+                continue
+
+            obj = self._repository[ref.target]
+            while isinstance(obj, pygit2.Tag):
+                obj = self._repository[obj.target]
+            if obj.type == pygit2.GIT_OBJ_COMMIT:
+                roots.append(obj.id)
+
+        for grafted_parents in self._grafts.grafts.values():
+            roots.extend(grafted_parents)
+        roots.extend(self._replaces[replaced] for replaced in self._replaces)
+        return roots
+
+    def _load_commits(self, sorter: TopoSort.TopoSort):
+        """
+        Feeds every commit reachable from the references into the sorter. Walks the commit graph instead of
+        iterating over the whole object database, so blobs, trees and tags are never inflated.
+        :return: number of commits read
+        """
+        walker = self._repository.walk(None, pygit2.GIT_SORT_NONE)
+        for root in self._load_roots():
+            try:
+                walker.push(root)
+            except (KeyError, pygit2.GitError):
+                # grafts and replacements may point to commits missing from this repository
+                continue
+
+        loaded_commits = 0
+        for commit in walker:
+            object_key = commit.id
+            if object_key in self._known_objects:
+                continue
+
+            self._known_objects.add(object_key)
+            self._read_commit(commit, sorter)
+            self.on_commit_loaded(object_key)
+            loaded_commits += 1
+
+        return loaded_commits
+
+    def _order_referenced_commits(self, sorter: TopoSort.TopoSort):
+        """
+        Makes commits mentioned in a message, e.g. by a cherry-pick, be processed before the commit mentioning them,
+        so the reference can be rewritten even when it is not an ancestor. References that would form a cycle are
+        left unordered, and so are left as they are.
+        """
+        for commit_id, candidates in self._message_references:
+            for candidate in candidates:
+                referenced = self._commit_prefix_index.resolve(candidate)
+                if referenced is not None and referenced != commit_id and referenced not in self.replaced_commits:
+                    sorter.add_weak_edge(commit_id, referenced)
+        self._message_references = []
+
+    def _count_objects(self):
+        # Only enumerates object ids from the pack indexes and loose object names, nothing is inflated
+        return sum(1 for _ in self._repository)
 
     def _read_commit(self, commit: pygit2.Commit, sorter: TopoSort.TopoSort):
         # fill parents. Possibly grafted and respecting refs/replace
-        commit_id = commit.oid
-        parents = [parent for parent in self._grafts[commit.oid]]
-        parents.extend([parent for parent in commit.parent_ids])
+        commit_id = commit.id
+        replaces = self._replaces.replaces
+        parent_ids = commit.parent_ids
+        grafted_parents = self._grafts.grafts.get(commit_id)
+        if grafted_parents is None:
+            effective_parents = parent_ids
+            parents = parent_ids
+        else:
+            effective_parents = grafted_parents
+            parents = list(grafted_parents)
+            parents.extend(parent for parent in parent_ids if parent not in grafted_parents)
 
         for parent in parents:
             sorter.add_edge(commit_id, parent)
-            sorter.add_edge(commit_id, self._replaces[parent])
-
-        # obtain possible dependencies from commit message
-        # message = commit.message
-        # match = self.sha1regex.search(message)
-        # while match:
-        #     sha1_candidate = match.group().lower()
-        #     object_candidate = self._repository.git_object_lookup_prefix(sha1_candidate)
-        #     if object_candidate and object_candidate.type == pygit2.GIT_OBJ_COMMIT:
-        #         sorter.add_edge(commit_id, self._replaces[object_candidate.oid])
-        #     match = self.sha1regex.search(message, match.end())
+            replacement = replaces.get(parent, parent)
+            if replacement != parent:
+                sorter.add_edge(commit_id, replacement)
 
         sorter.add_vertex(commit_id)
 
+        if self._rewrite_commit_references:
+            candidates = set(self.sha1regex.findall(commit.message))
+            if candidates:
+                self._message_references.append((commit_id, tuple(candidates)))
+
+        effective_parents = tuple(replaces.get(parent, parent) for parent in effective_parents)
+        self._effective_parents[commit_id] = \
+            effective_parents[0] if len(effective_parents) == 1 else effective_parents
+
+    def _parents_of(self, commit_id: pygit2.Oid):
+        """
+        :return: tuple of parents recorded while loading, never looked up in the repository
+        """
+        parents = self._effective_parents[commit_id]
+        return (parents,) if isinstance(parents, pygit2.Oid) else parents
+
     def _process_commit(self, commit_id: pygit2.Oid):
         if commit_id in self.replaced_commits:
             return
@@ -96,10 +260,10 @@ class RepositoryProcessor:
 
         assert (commit.type == pygit2.GIT_OBJ_COMMIT)
 
-        for parent_id in self._grafts[commit_id]:
+        original_parents = self._parents_of(commit_id)
+        for parent_id in original_parents:
             assert parent_id in self.replaced_commits
 
-        original_parents = tuple(self._replaces[parent] for parent in self._grafts[commit_id])
         parents = []
 
         for parent in original_parents:
@@ -122,10 +286,15 @@ class RepositoryProcessor:
         committer = self.filter_committer(commit.committer)
 
         new_commit = self.filter_commit(commit_id, author, committer, message, tree, parents)
+        self._remember_commit(commit_id, new_commit)
+        if self._journal is not None:
+            self._journal.append(commit_id, new_commit)
+
+    def _remember_commit(self, commit_id: pygit2.Oid, new_commit):
         self.replaced_commits[commit_id] = new_commit
         if (isinstance(new_commit, pygit2.Oid)):
             self.replaced_commits[new_commit] = new_commit
-        self._known_objects.add(new_commit)
+            self._known_objects.add(new_commit)
 
     def _build_commit_tree(self, original_tree: pygit2.Tree):
         tree = TreeProcessor.TreeWrapper(self._repository, original_tree)
@@ -145,7 +314,27 @@ class RepositoryProcessor:
     def filter_tree(self, tree: TreeProcessor.TreeWrapper):
         return tree
 
+    def rewrite_commit_references(self, message):
+        """
+        Replaces abbreviated and full SHA1s of commits that are already rewritten with their new ids, keeping the
+        length of the abbreviation. Referenced commits are processed first (see _order_referenced_commits); references
+        that could not be ordered that way are left as they are, as are ambiguous abbreviations.
+        """
+        def replace(match):
+            candidate = match.group(1)
+            original = self._commit_prefix_index.resolve(candidate)
+            if original is None:
+                return candidate
+            rewritten = self.replaced_commits.get(original)
+            if not isinstance(rewritten, pygit2.Oid):
+                return candidate
+            return rewritten.hex[:len(candidate)]
+
+        return self.sha1regex.sub(replace, message)
+
     def filter_message(self, message):
+        if self._commit_prefix_index is not None:
+            return self.rewrite_commit_references(message)
         return message
 
     def filter_author(self, author):
@@ -167,6 +356,9 @@ class RepositoryProcessor:
     def on_memory_error(self, sha1):
         pass
 
+    def on_journal_replayed(self, commit_count):
+        pass
+
     def on_begin_load(self):
         pass
 
@@ -176,6 +368,12 @@ class RepositoryProcessor:
     def on_commit_loaded(self, sha1):
         pass
 
+    def on_commits_queued(self, queue):
+        """
+        Receives the ids of the commits about to be processed, in processing order
+        """
+        pass
+
     def on_begin_processing(self):
         pass
 
@@ -1,4 +1,5 @@
 import shutil
+import hashlib
 from unicodedata import normalize
 import tempfile
 from pathlib import Path
@@ -6,11 +7,14 @@ from pathlib import Path
 SOURCE_REPO_PATH = Path("path/to/source/repo")
 OUTPUT_REPO_PATH = Path("path/to/output/repo")
 
+# Kept outside the output repo, so it survives full reconversions
+TRANSFORM_CACHE_PATH = Path("path/to/transform-cache.sqlite")
+
 
 APP1_SOURCE_PATH = Path("App1/src")
 APP2_SOURCE_PATH = Path("App2/client/src")
 
-JS_SOURCE_PATHS = set([APP1_SOURCE_PATH, APP2_SOUREC_PATH])
+JS_SOURCE_PATHS = set([APP1_SOURCE_PATH, APP2_SOURCE_PATH])
 
 PYTHON_SERVICES = ["PythonService1", "PythonService2"]
 
@@ -63,7 +67,7 @@ def isFormattablePythonSourceFile(pathString):
                 # File is at the top level of the module
                 shouldFormat = filePath.name not in PYTHON_FILES_TO_IGNORE
             else:
-                moduleSourceFolders = PYTHON_SOURCE_SUBFOLDERS.get(moduleFolder, [])
+                moduleSourceFolders = EXTRA_PYTHON_SOURCE_SUBFOLDERS.get(moduleFolder, [])
                 # Some services have actual code that's nested one level deep
                 shouldFormat = filePath.parts[1] in moduleSourceFolders
 
@@ -105,4 +109,16 @@ def replaceEntry(array, old, new):
 
 def normalizeEntry(fileEntry):
     newText = normalize("NFKD", str(fileEntry["source"], 'utf-8', 'ignore'))
-    return update(fileEntry, {"source": newText})
\ No newline at end of file
+    return update(fileEntry, {"source": newText})
+
+def fingerprintFiles(filePaths, *extraValues):
+    """Hash the names and contents of a set of files, plus any extra values. Missing files are hashed as missing.
+    """
+    digest = hashlib.sha1()
+    for filePath in sorted(str(filePath) for filePath in filePaths):
+        digest.update(filePath.encode("utf-8"))
+        path = Path(filePath)
+        digest.update(path.read_bytes() if path.exists() else b"<missing>")
+    for value in extraValues:
+        digest.update(str(value).encode("utf-8"))
+    return digest.hexdigest()
@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import pygit2
+
+from pylter_branch.PackedRefs import PackedRefs
+
+
+CLONE_MODES = ("clone", "hardlink", "alternates")
+
+# Same refs a bare clone_repository would create in the output repo
+COPIED_REF_PREFIXES = ("refs/heads/", "refs/tags/")
+
+
+def setUpOutputRepo(sourcePath, destPath, cloneMode = "clone"):
+    """
+    Creates the bare output repository the history gets rewritten in, with the source's branches and tags.
+
+    "clone":      regular full clone, every object is copied.
+    "hardlink":   the source's packs and loose objects are hardlinked (copied across devices), like git clone --local.
+    "alternates": nothing is copied, the output repo reads the source's objects through objects/info/alternates.
+                  The source repo must then not be gc'ed or pruned while the output repo is in use.
+    In the last two modes, only the objects written by the rewrite go into the output repo.
+    """
+    if cloneMode not in CLONE_MODES:
+        raise ValueError("Unknown clone mode: {0}".format(cloneMode))
+
+    if cloneMode == "clone":
+        return pygit2.clone_repository(sourcePath, destPath, True)
+
+    sourceRepo = pygit2.Repository(sourcePath)
+    destRepo = pygit2.init_repository(destPath, True)
+
+    sourceObjectsPath = os.path.join(sourceRepo.path, "objects")
+    destObjectsPath = os.path.join(destRepo.path, "objects")
+
+    if cloneMode == "hardlink":
+        linkObjects(sourceObjectsPath, destObjectsPath)
+    else:
+        with open(os.path.join(destObjectsPath, "info", "alternates"), "a") as alternatesFile:
+            alternatesFile.write(os.path.abspath(sourceObjectsPath) + "\n")
+        # Objects are looked up through the alternates file when the repository is opened
+        destRepo = pygit2.Repository(destPath)
+
+    copyRefs(sourceRepo, destRepo)
+    destRepo.remotes.create("origin", sourcePath)
+    return destRepo
+
+
+def linkObjects(sourceObjectsPath, destObjectsPath):
+    for directoryPath, _, fileNames in os.walk(sourceObjectsPath):
+        destDirectoryPath = os.path.join(destObjectsPath, os.path.relpath(directoryPath, sourceObjectsPath))
+        os.makedirs(destDirectoryPath, exist_ok=True)
+
+        for fileName in fileNames:
+            sourceFilePath = os.path.join(directoryPath, fileName)
+            destFilePath = os.path.join(destDirectoryPath, fileName)
+            if os.path.exists(destFilePath):
+                continue
+            try:
+                os.link(sourceFilePath, destFilePath)
+            except OSError:
+                # Different filesystem, or no hardlink support
+                shutil.copy2(sourceFilePath, destFilePath)
+
+
+def copyRefs(sourceRepo, destRepo):
+    packedRefs = PackedRefs(destRepo)
+    for refName in sourceRepo.listall_references():
+        ref = sourceRepo.references[refName]
+        if ref.type == pygit2.GIT_REF_SYMBOLIC or not refName.startswith(COPIED_REF_PREFIXES):
+            continue
+        packedRefs[refName] = ref.target
+    packedRefs.write()
+
+    if not sourceRepo.head_is_unborn:
+        headName = sourceRepo.references["HEAD"].target
+        if headName in packedRefs:
+            destRepo.references.create("HEAD", headName, force=True)
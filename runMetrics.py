@@ -0,0 +1,143 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import heapq
+import json
+import os
+import time
+
+
+class CommitMetrics:
+    """
+    Stage timers and counters of one commit's rewrite. Created when the commit is prepared on a pipeline worker,
+    travels with the prepared commit and is completed by the main thread when the commit is written.
+    """
+
+    def __init__(self, commitId):
+        self.commitId = str(commitId)
+        self.stageTimes = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stageTimes[name] += time.perf_counter() - startTime
+
+    def count(self, name, amount = 1):
+        self.counters[name] += amount
+
+    def addShare(self, otherMetrics, share):
+        """
+        Adds a share of other metrics, e.g. of a request that served several commits
+        """
+        for name, seconds in otherMetrics.stageTimes.items():
+            self.stageTimes[name] += seconds * share
+        for name, amount in otherMetrics.counters.items():
+            self.counters[name] += round(amount * share)
+
+    def totalTime(self):
+        return sum(self.stageTimes.values())
+
+    def asRecord(self):
+        return {
+            "commit" : self.commitId,
+            "seconds" : round(self.totalTime(), 6),
+            "stages" : {name : round(seconds, 6) for name, seconds in self.stageTimes.items()},
+            "counters" : dict(self.counters),
+        }
+
+
+def timedStage(metrics, name):
+    """
+    metrics.stage(name), or nothing when there are no metrics to record into
+    """
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+
+class RunMetrics:
+    """
+    Totals of all commit metrics of a run. Every commit is appended to a JSON-lines file, and the totals can also
+    be exported as a Prometheus text file (e.g. for node_exporter's textfile collector), rewritten every
+    `prometheusInterval` commits.
+    """
+
+    def __init__(self, jsonLinesPath = None, prometheusPath = None, prometheusInterval = 50, slowestCount = 10):
+        self._jsonLinesFile = open(str(jsonLinesPath), "a") if jsonLinesPath else None
+        self._prometheusPath = str(prometheusPath) if prometheusPath else None
+        self._prometheusInterval = prometheusInterval
+        self._slowestCount = slowestCount
+
+        self.commitCount = 0
+        self.stageTimes = defaultdict(float)
+        self.counters = defaultdict(int)
+        # min-heap of (seconds, commit ID, stage times) of the slowest commits so far
+        self._slowestCommits = []
+
+    def record(self, commitMetrics):
+        self.commitCount += 1
+        for name, seconds in commitMetrics.stageTimes.items():
+            self.stageTimes[name] += seconds
+        for name, amount in commitMetrics.counters.items():
+            self.counters[name] += amount
+
+        entry = (commitMetrics.totalTime(), commitMetrics.commitId, dict(commitMetrics.stageTimes))
+        if len(self._slowestCommits) < self._slowestCount:
+            heapq.heappush(self._slowestCommits, entry)
+        else:
+            heapq.heappushpop(self._slowestCommits, entry)
+
+        if self._jsonLinesFile is not None:
+            self._jsonLinesFile.write(json.dumps(commitMetrics.asRecord()) + "\n")
+
+        if self._prometheusPath and self.commitCount % self._prometheusInterval == 0:
+            self.writePrometheus()
+
+    def writePrometheus(self):
+        lines = [
+            "# HELP repo_rewrite_commits_total Commits rewritten in this run",
+            "# TYPE repo_rewrite_commits_total counter",
+            "repo_rewrite_commits_total {0}".format(self.commitCount),
+            "# HELP repo_rewrite_stage_seconds_total Time spent per rewrite stage",
+            "# TYPE repo_rewrite_stage_seconds_total counter",
+        ]
+        lines.extend('repo_rewrite_stage_seconds_total{{stage="{0}"}} {1:.6f}'.format(name, seconds)
+                     for name, seconds in sorted(self.stageTimes.items()))
+        lines.extend([
+            "# HELP repo_rewrite_items_total Files, bytes and cache lookups per kind",
+            "# TYPE repo_rewrite_items_total counter",
+        ])
+        lines.extend('repo_rewrite_items_total{{kind="{0}"}} {1}'.format(name, amount)
+                     for name, amount in sorted(self.counters.items()))
+
+        # Written aside and renamed, so a scraper never reads a half-written file
+        temporaryPath = self._prometheusPath + ".tmp"
+        with open(temporaryPath, "w") as prometheusFile:
+            prometheusFile.write("\n".join(lines) + "\n")
+        os.replace(temporaryPath, self._prometheusPath)
+
+    def summaryMessage(self):
+        totalTime = sum(self.stageTimes.values())
+        lines = ["Time per stage over {0} commits:".format(self.commitCount)]
+        for name, seconds in sorted(self.stageTimes.items(), key=lambda item: item[1], reverse=True):
+            share = 100.0 * seconds / totalTime if totalTime else 0.0
+            lines.append("  {0: <20} {1: >10.3f}s {2: >5.1f}%".format(name, seconds, share))
+
+        lines.append("Counters:")
+        for name, amount in sorted(self.counters.items()):
+            lines.append("  {0: <20} {1: >10}".format(name, amount))
+
+        lines.append("Slowest commits:")
+        for seconds, commitId, stageTimes in sorted(self._slowestCommits, reverse=True):
+            slowestStage = max(stageTimes, key=stageTimes.get) if stageTimes else "-"
+            lines.append("  {0} {1: >10.3f}s (mostly {2})".format(commitId, seconds, slowestStage))
+
+        return "\n".join(lines)
+
+    def close(self):
+        if self._prometheusPath:
+            self.writePrometheus()
+        if self._jsonLinesFile is not None:
+            self._jsonLinesFile.close()
+            self._jsonLinesFile = None
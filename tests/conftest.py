@@ -0,0 +1,5 @@
+from pathlib import Path
+import sys
+
+ROOT_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_PATH))
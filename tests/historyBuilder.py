@@ -0,0 +1,30 @@
+import pygit2
+
+SIGNATURE = pygit2.Signature("A U Thor", "author@example.com", 1500000000, 60)
+
+
+class HistoryBuilder:
+    """
+    Writes commits into a bare repository from {path: contents} snapshots, so tests can describe a history directly
+    """
+
+    def __init__(self, repositoryPath):
+        self.repo = pygit2.init_repository(str(repositoryPath), True)
+        self.commitNumber = 0
+
+    def tree(self, files):
+        index = pygit2.Index()
+        for path, contents in files.items():
+            index.add(pygit2.IndexEntry(path, self.repo.create_blob(contents), pygit2.GIT_FILEMODE_BLOB))
+        return index.write_tree(self.repo)
+
+    def commit(self, files, parents = (), message = None):
+        self.commitNumber += 1
+        if message is None:
+            message = "commit {0}\n".format(self.commitNumber)
+        # Distinct times keep the order of the history stable
+        signature = pygit2.Signature(SIGNATURE.name, SIGNATURE.email, SIGNATURE.time + self.commitNumber, SIGNATURE.offset)
+        return self.repo.create_commit(None, signature, signature, message, self.tree(files), list(parents))
+
+    def branch(self, name, commitId):
+        self.repo.references.create("refs/heads/" + name, commitId, force=True)
@@ -0,0 +1,318 @@
+import pygit2
+import pytest
+
+import cloneAndProcessRepo
+import transformJSFiles
+from historyBuilder import HistoryBuilder
+from transformCache import TransformCache
+
+
+def fakeTransport(commitId, jsFilesList, metrics = None):
+    return [dict(fileEntry, source=fileEntry["source"].upper()) for fileEntry in jsFilesList]
+
+def fakePYFormatter(filesList):
+    return [dict(fileEntry, source=fileEntry["source"].decode() + "# formatted\n") for fileEntry in filesList]
+
+
+@pytest.fixture
+def fakeTransforms(monkeypatch):
+    monkeypatch.setattr(transformJSFiles, "transformJSFiles", fakeTransport)
+    monkeypatch.setattr(cloneAndProcessRepo, "formatPYFiles", fakePYFormatter)
+
+
+def buildHistory(path):
+    """Nested edits, renames, file <-> directory changes and merges, with JS, PY and other files"""
+    builder = HistoryBuilder(path)
+
+    files = {
+        "App1/src/a/one.js" : b"one\n",
+        "App1/src/a/two.js" : b"two\n",
+        "PythonService1/service.py" : b"x = 1\n",
+        "docs/readme.txt" : b"readme\n",
+        "docs/notes" : b"notes as a file\n",
+    }
+    root = builder.commit(files)
+
+    files["App1/src/a/one.js"] = b"one, changed\n"
+    files["App1/src/b/deep/three.js"] = b"three\n"
+    second = builder.commit(files, [root])
+
+    # Rename into another directory, and a file that becomes a directory
+    files["App1/src/c/two.js"] = files.pop("App1/src/a/two.js")
+    del files["docs/notes"]
+    files["docs/notes/first.txt"] = b"notes as a directory\n"
+    third = builder.commit(files, [second])
+
+    side = dict(files)
+    side["App1/src/side.js"] = b"side\n"
+    side["PythonService1/side.py"] = b"y = 2\n"
+    sideCommit = builder.commit(side, [second])
+
+    # Merge, and a directory that becomes a file again
+    merged = dict(files)
+    merged["App1/src/side.js"] = side["App1/src/side.js"]
+    merged["PythonService1/side.py"] = side["PythonService1/side.py"]
+    del merged["docs/notes/first.txt"]
+    merged["docs/notes"] = b"notes as a file again\n"
+    merge = builder.commit(merged, [third, sideCommit])
+
+    # Everything under a directory removed, and a nested edit next to it
+    del merged["App1/src/b/deep/three.js"]
+    merged["App1/src/c/two.js"] = b"two, changed\n"
+    last = builder.commit(merged, [merge])
+
+    builder.branch("master", last)
+    return builder.repo
+
+
+def rewrite(sourcePath, destPath, **processorOptions):
+    destRepo = pygit2.clone_repository(str(sourcePath), str(destPath), True)
+    processor = cloneAndProcessRepo.MyRepoProcessor(destRepo, jsInFlight=0, **processorOptions)
+    processor.process()
+    return destRepo, processor
+
+
+def test_patchParentTreeMatchesIndexRewrite(tmp_path, fakeTransforms):
+    sourceRepo = buildHistory(tmp_path / "source")
+    originalIds = [commit.id for commit in sourceRepo.walk(sourceRepo.branches["master"].target)]
+    assert len(originalIds) == 6
+
+    indexRepo, indexProcessor = rewrite(tmp_path / "source", tmp_path / "index", useIndex=True)
+    patchRepo, patchProcessor = rewrite(tmp_path / "source", tmp_path / "patch", useIndex=False)
+
+    for originalId in originalIds:
+        indexCommitId = indexProcessor.replaced_commits[originalId]
+        patchCommitId = patchProcessor.replaced_commits[originalId]
+        assert indexRepo[indexCommitId].tree_id == patchRepo[patchCommitId].tree_id
+
+    assert indexRepo.branches["master"].target == patchRepo.branches["master"].target
+
+    tree = patchRepo.branches["master"].peel().tree
+    assert tree["App1/src/c/two.js"].id == patchRepo.create_blob(b"TWO, CHANGED\n")
+    assert tree["App1/src/side.js"].id == patchRepo.create_blob(b"SIDE\n")
+    assert tree["docs/notes"].id == patchRepo.create_blob(b"notes as a file again\n")
+    assert "App1/src/a/two.js" not in tree
+    assert "App1/src/b" not in tree
+
+
+def test_uniqueJSBlobBatchesAreBoundedByBytes(tmp_path, monkeypatch):
+    builder = HistoryBuilder(tmp_path / "source")
+    root = builder.commit({"docs/readme.txt" : b"readme\n"})
+    sizes = [10, 20, 30, 5, 100, 1, 1, 1, 1]
+    # distinct contents, so every file is a blob of its own
+    files = {"App1/src/file{0}.js".format(number) : (b"%d" % number) * size for number, size in enumerate(sizes)}
+    commitId = builder.commit(files, [root])
+
+    monkeypatch.setattr(cloneAndProcessRepo, "JS_BATCH_MAX_BYTES", 40)
+    monkeypatch.setattr(cloneAndProcessRepo, "UNIQUE_BLOB_BATCH_FILES", 3)
+    batches = []
+    monkeypatch.setattr(cloneAndProcessRepo.MyRepoProcessor, "transformJSBatch",
+                        lambda self, batchNumber, batch: batches.append([path for _, (path, _) in batch]))
+
+    cache = TransformCache(tmp_path / "cache.sqlite")
+    processor = cloneAndProcessRepo.MyRepoProcessor(builder.repo, transformCache=cache, twoPhase=True, jsInFlight=0)
+    processor.transformUniqueBlobs([commitId])
+
+    assert sorted(path for batch in batches for path in batch) == sorted(files)
+    for batch in batches:
+        assert len(batch) <= 3
+        assert len(batch) == 1 or sum(len(files[path]) for path in batch) <= 40
+    assert ["App1/src/file4.js"] in batches
+
+
+def test_failedPYFormattingIsNotCached(tmp_path, monkeypatch):
+    monkeypatch.setattr(transformJSFiles, "transformJSFiles", fakeTransport)
+    builder = HistoryBuilder(tmp_path / "source")
+    root = builder.commit({"docs/readme.txt" : b"readme\n"})
+    files = {"PythonService1/good.py" : b"x=1\n", "PythonService1/bad.py" : b"def f(:\n"}
+    commitId = builder.commit(files, [root])
+    builder.branch("master", commitId)
+    goodId, badId = (pygit2.hash(files[path]) for path in ("PythonService1/good.py", "PythonService1/bad.py"))
+
+    for twoPhase in (True, False):
+        cache = TransformCache(tmp_path / "cache-{0}.sqlite".format(twoPhase))
+        processor = cloneAndProcessRepo.MyRepoProcessor(builder.repo, transformCache=cache, jsInFlight=0)
+        if twoPhase:
+            processor.transformUniqueBlobs([commitId])
+        else:
+            processor.process()
+
+        fingerprint = processor.pyFingerprint
+        assert cache.contains(goodId, "py", fingerprint)
+        assert not cache.contains(badId, "py", fingerprint)
+
+
+def requireImportTransport(commitId, jsFilesList, metrics = None):
+    # Like the codemods, adds the import that the per-commit fixups remove from the first file of each name
+    return [dict(fileEntry, source='import require from "require";' + fileEntry["source"] + "// transformed\n")
+            for fileEntry in jsFilesList]
+
+
+def test_twoPhaseRewriteMatchesOnePhase(tmp_path, monkeypatch):
+    # The PY formatting of phase one runs in spawned processes, so both runs use the real formatter
+    monkeypatch.setattr(transformJSFiles, "transformJSFiles", requireImportTransport)
+    builder = HistoryBuilder(tmp_path / "source")
+    files = {"App1/src/main.js" : b"main\n", "PythonService1/service.py" : b"x = 1\n"}
+    root = builder.commit(files)
+
+    files["App1/src/shared.js"] = b"shared\n"
+    # the same blob at another path
+    files["App1/src/copy/shared.js"] = b"shared\n"
+    # first-match dependent: only the first largeChunk.js of a commit gets the import removed
+    files["App1/src/largeChunk.js"] = b"chunk\n"
+    files["App1/src/sub/largeChunk.js"] = b"chunk\n"
+    files["PythonService1/service.py"] = b"x=2\n"
+    second = builder.commit(files, [root])
+
+    files["App1/src/later/shared.js"] = b"shared\n"
+    files["App1/src/main.js"] = b"main, changed\n"
+    files["PythonService1/other.py"] = b"x=2\n"
+    last = builder.commit(files, [second])
+    builder.branch("master", last)
+
+    onePhaseRepo, onePhase = rewrite(tmp_path / "source", tmp_path / "one")
+    twoPhaseRepo, twoPhase = rewrite(tmp_path / "source", tmp_path / "two", twoPhase=True,
+                                     transformCache=TransformCache(tmp_path / "cache.sqlite"))
+
+    for commitId in (root, second, last):
+        assert onePhase.replaced_commits[commitId] == twoPhase.replaced_commits[commitId]
+    assert onePhaseRepo.branches["master"].target == twoPhaseRepo.branches["master"].target
+
+    tree = twoPhaseRepo.branches["master"].peel().tree
+    assert twoPhaseRepo[tree["App1/src/later/shared.js"].id].data == b'import require from "require";shared\n// transformed\n'
+    assert twoPhaseRepo[tree["PythonService1/other.py"].id].data == b"x = 2\n"
+    # the distinct blobs were transformed once, in phase one, and the replay found them in the cache
+    assert twoPhase.transformCache.contains(pygit2.hash(b"shared\n"), "transform", twoPhase.jsFingerprint)
+    assert twoPhaseRepo[tree["App1/src/largeChunk.js"].id].data == b"chunk\n// transformed\n"
+    assert twoPhaseRepo[tree["App1/src/sub/largeChunk.js"].id].data == b'import require from "require";chunk\n// transformed\n'
+
+
+def buildMergeHistory(path):
+    """A merge bringing in JS and PY files from a side branch, and a merge keeping the tree of its second parent"""
+    builder = HistoryBuilder(path)
+    files = {"App1/src/main.js" : b"main\n", "PythonService1/service.py" : b"x = 1\n"}
+    root = builder.commit(files)
+
+    side = dict(files)
+    side["App1/src/side.js"] = b"side\n"
+    side["PythonService1/side.py"] = b"y = 2\n"
+    sideCommit = builder.commit(side, [root])
+    side["App1/src/side.js"] = b"side, changed\n"
+    sideTip = builder.commit(side, [sideCommit])
+
+    files["App1/src/main.js"] = b"main, changed\n"
+    mainTip = builder.commit(files, [root])
+
+    merged = dict(side)
+    merged["App1/src/main.js"] = files["App1/src/main.js"]
+    merge = builder.commit(merged, [mainTip, sideTip])
+
+    other = dict(merged)
+    other["docs/readme.txt"] = b"readme\n"
+    other["App1/src/main.js"] = b"main, changed on other\n"
+    otherCommit = builder.commit(other, [merge])
+    sameTreeMerge = builder.commit(other, [merge, otherCommit])
+
+    last = builder.commit(dict(other, **{"App1/src/last.js" : b"last\n"}), [sameTreeMerge])
+    builder.branch("master", last)
+    return builder.repo, sideCommit, merge, sameTreeMerge
+
+
+class MergeRecordingProcessor(cloneAndProcessRepo.MyRepoProcessor):
+    """Records the files each commit transforms; can skip commits and turn off the reuse of merged files"""
+
+    def __init__(self, *args, skippedCommits = (), reuseMergedFiles = True, **kwargs):
+        self.skippedCommits = set(skippedCommits)
+        self.reuseMergedFiles = reuseMergedFiles
+        self.transformedPaths = {}
+        self.fullMergePreparations = []
+        super().__init__(*args, **kwargs)
+
+    def prepareCommit(self, repo, commitId, reuseMergedFiles = True, metrics = None):
+        if not reuseMergedFiles:
+            self.fullMergePreparations.append(commitId)
+        preparedCommit = super().prepareCommit(repo, commitId, reuseMergedFiles and self.reuseMergedFiles, metrics)
+        if preparedCommit is not None:
+            self.transformedPaths[commitId] = sorted(preparedCommit.jsPaths + preparedCommit.pyPaths)
+        return preparedCommit
+
+    def filter_commit(self, commit_id, author, committer, message, tree, parents):
+        if commit_id in self.skippedCommits:
+            return self.skip_commit(commit_id, author, committer, message, tree, parents)
+        return super().filter_commit(commit_id, author, committer, message, tree, parents)
+
+
+def rewriteMerges(sourcePath, destPath, **processorOptions):
+    destRepo = pygit2.clone_repository(str(sourcePath), str(destPath), True)
+    processor = MergeRecordingProcessor(destRepo, jsInFlight=0, lookahead=0, **processorOptions)
+    processor.process()
+    return destRepo, processor
+
+
+def assertSameRewrite(repo, processor, otherRepo, otherProcessor, commitIds):
+    for commitId in commitIds:
+        assert repo[processor.replaced_commits[commitId]].tree_id == otherRepo[otherProcessor.replaced_commits[commitId]].tree_id
+    assert repo.branches["master"].target == otherRepo.branches["master"].target
+
+
+def test_mergeReusesFilesOfTheRewrittenParents(tmp_path, fakeTransforms):
+    sourceRepo, sideCommit, merge, sameTreeMerge = buildMergeHistory(tmp_path / "source")
+    commitIds = [commit.id for commit in sourceRepo.walk(sourceRepo.branches["master"].target)]
+
+    reuseRepo, reuse = rewriteMerges(tmp_path / "source", tmp_path / "reuse")
+    fullRepo, full = rewriteMerges(tmp_path / "source", tmp_path / "full", reuseMergedFiles=False)
+
+    assertSameRewrite(reuseRepo, reuse, fullRepo, full, commitIds)
+
+    # The side branch's files were transformed on the side branch only
+    assert reuse.transformedPaths[merge] == []
+    assert full.transformedPaths[merge] == ["App1/src/side.js", "PythonService1/side.py"]
+    # The merge with the tree of its second parent takes that parent's rewritten tree
+    assert reuse.transformedPaths[sameTreeMerge] == []
+    assert full.transformedPaths[sameTreeMerge] == ["App1/src/main.js"]
+    assert "docs/readme.txt" in reuseRepo[reuse.replaced_commits[sameTreeMerge]].tree
+    assert reuse.fullMergePreparations == []
+
+    assert reuse.runMetrics.counters["mergedFiles"] == 2
+    assert reuse.runMetrics.counters["sameTreeMerges"] == 1
+    assert reuse.runMetrics.counters["mergeFallbacks"] == 0
+    assert full.runMetrics.counters["mergedFiles"] == 0
+    assert full.runMetrics.counters["sameTreeMerges"] == 0
+
+
+def test_mergeWithASkippedParentIsTransformedAgain(tmp_path, fakeTransforms):
+    sourceRepo, sideCommit, merge, sameTreeMerge = buildMergeHistory(tmp_path / "source")
+    commitIds = [commit.id for commit in sourceRepo.walk(sourceRepo.branches["master"].target) if commit.id != sideCommit]
+
+    # Skipping the side branch's first commit leaves side.py out of the rewritten side branch
+    reuseRepo, reuse = rewriteMerges(tmp_path / "source", tmp_path / "reuse", skippedCommits=[sideCommit])
+    fullRepo, full = rewriteMerges(tmp_path / "source", tmp_path / "full", skippedCommits=[sideCommit],
+                                   reuseMergedFiles=False)
+
+    assertSameRewrite(reuseRepo, reuse, fullRepo, full, commitIds)
+
+    assert reuse.fullMergePreparations == [merge]
+    assert reuse.transformedPaths[merge] == ["App1/src/side.js", "PythonService1/side.py"]
+    assert reuse.runMetrics.counters["mergeFallbacks"] == 1
+    assert reuse.runMetrics.counters["mergedFiles"] == 0
+    tree = reuseRepo[reuse.replaced_commits[merge]].tree
+    assert reuseRepo[tree["PythonService1/side.py"].id].data == b"y = 2\n# formatted\n"
+
+
+def test_pipelineIsClosedWhenACommitFails(tmp_path, fakeTransforms, monkeypatch):
+    repo = buildHistory(tmp_path / "source")
+
+    def failingRewrite(self, currentCommit, *args):
+        if currentCommit.parent_ids:
+            raise RuntimeError("rewrite failed")
+        return currentCommit.id
+
+    monkeypatch.setattr(cloneAndProcessRepo.MyRepoProcessor, "rewriteCommit", failingRewrite)
+    processor = cloneAndProcessRepo.MyRepoProcessor(repo, jsInFlight=0, lookahead=4)
+    with pytest.raises(RuntimeError, match="rewrite failed"):
+        processor.process()
+
+    # The workers are shut down, with no prepared commits left behind
+    with pytest.raises(RuntimeError):
+        processor.commitPipeline._executor.submit(print)
+    assert processor.commitPipeline._futures == {}
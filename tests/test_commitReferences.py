@@ -0,0 +1,100 @@
+import pygit2
+import pytest
+
+from pylter_branch import RepositoryProcessor
+from pylter_branch import TopoSort
+from historyBuilder import HistoryBuilder
+
+
+class RenamingProcessor(RepositoryProcessor):
+    """Changes every author, so every commit gets a new id"""
+
+    def filter_author(self, author):
+        return pygit2.Signature("Renamed", author.email, author.time, author.offset)
+
+
+def rewrite(repo):
+    processor = RenamingProcessor(repo, rewrite_commit_references=True)
+    processor.process()
+    return processor
+
+
+def test_cherryPickFromALaterBranchIsRewritten(tmp_path):
+    builder = HistoryBuilder(tmp_path / "repo")
+    root = builder.commit({"a.txt": b"root\n"})
+    tip = root
+    for number in range(5):
+        tip = builder.commit({"a.txt": b"aaa %d\n" % number}, [tip])
+    builder.branch("aaa", tip)
+    picked = builder.commit({"a.txt": b"aaa 4\n"}, [root],
+                            "pick\n\n(cherry picked from commit {0})\nsee also {1}\n".format(tip.hex, tip.hex[:10]))
+    builder.branch("zzz", picked)
+
+    processor = rewrite(builder.repo)
+
+    newTip = processor.replaced_commits[tip]
+    newPicked = builder.repo[processor.replaced_commits[picked]]
+    assert newTip != tip
+    assert newPicked.message == \
+        "pick\n\n(cherry picked from commit {0})\nsee also {1}\n".format(newTip.hex, newTip.hex[:10])
+
+
+def test_onlyNumbersMatchingACommitAreRewritten(tmp_path):
+    builder = HistoryBuilder(tmp_path / "repo")
+    root = builder.commit({"a.txt": b"root\n"})
+    # a commit whose abbreviated id is made of digits only
+    decimalCommit = None
+    while decimalCommit is None:
+        candidate = builder.commit({"a.txt": b"root\n"}, message="root {0}\n".format(builder.commitNumber))
+        if candidate.hex[:7].isdigit():
+            decimalCommit = candidate
+    builder.branch("decimal", decimalCommit)
+    # and a decimal number that is not the prefix of any object
+    issueNumber = next(str(number) for number in range(1000000, 10000000)
+                       if not any(oid.hex.startswith(str(number)) for oid in builder.repo))
+    child = builder.commit({"a.txt": b"child\n"}, [root],
+                           "fixes issue {0}, see {1}\n".format(issueNumber, decimalCommit.hex[:7]))
+    builder.branch("master", child)
+
+    processor = rewrite(builder.repo)
+
+    newDecimalCommit = processor.replaced_commits[decimalCommit]
+    assert newDecimalCommit != decimalCommit
+    assert builder.repo[processor.replaced_commits[child]].message == \
+        "fixes issue {0}, see {1}\n".format(issueNumber, newDecimalCommit.hex[:7])
+
+
+def test_weakEdgesClosingACycleAreIgnored():
+    sorter = TopoSort.TopoSort()
+    sorter.add_edge("b", "a")
+    sorter.add_edge("c", "b")
+    sorter.add_weak_edge("a", "c")
+    sorter.add_weak_edge("b", "d")
+
+    order = sorter.sort()
+
+    assert order.index("c") < order.index("b") < order.index("a")
+    assert order.index("b") < order.index("d")
+
+
+def test_cycleOfRegularEdgesRaises():
+    sorter = TopoSort.TopoSort()
+    sorter.add_edge("a", "b")
+    sorter.add_edge("b", "a")
+    sorter.add_weak_edge("a", "c")
+
+    with pytest.raises(RuntimeError):
+        sorter.sort()
+
+
+def test_manyWeakCyclesAreBrokenInLinearTime():
+    sorter = TopoSort.TopoSort()
+    vertexCount = 100000
+    for vertex in range(1, vertexCount):
+        sorter.add_edge(vertex, vertex - 1)
+        # every vertex also refers to its child, each reference closing a cycle
+        sorter.add_weak_edge(vertex - 1, vertex)
+
+    order = sorter.sort()
+
+    assert order == list(range(vertexCount - 1, -1, -1))
@@ -0,0 +1,75 @@
+import time
+
+import estimateConversionCost
+from historyBuilder import HistoryBuilder
+
+
+def slowTransform(seconds):
+    def transform(*args):
+        time.sleep(seconds)
+    return transform
+
+
+def buildHistory(path, withPY = True):
+    builder = HistoryBuilder(path)
+    files = {"App1/src/main.js" : b"main\n", "docs/readme.txt" : b"readme\n"}
+    if withPY:
+        files["PythonService1/service.py"] = b"x = 1\n"
+    commits = [builder.commit(files)]
+    for number in range(1, 7):
+        # growing JS payloads, and the same PY blob in every other commit
+        files["App1/src/file{0}.js".format(number)] = b"j" * (1000 * number)
+        if withPY and number % 2 == 0:
+            files["PythonService1/service{0}.py".format(number)] = b"x = 2\n"
+        commits.append(builder.commit(files, [commits[-1]]))
+    builder.branch("master", commits[-1])
+    return builder.repo
+
+
+def test_costsAreCountedPerCommit(tmp_path):
+    estimator = estimateConversionCost.CostEstimator(buildHistory(tmp_path / "repo"))
+    estimator.analyze()
+
+    costs = estimator.commitCosts
+    assert len(costs) == 6
+    assert [(cost.jsFiles, cost.jsBytes) for cost in costs] == [(1, 1000 * number) for number in range(1, 7)]
+    assert [(cost.pyFiles, cost.pyBytes) for cost in costs] == [(0, 0), (1, 6)] * 3
+    assert len(estimator.distinctJSBlobs) == 6
+    assert list(estimator.distinctPYBlobs.values()) == [6]
+
+
+def test_sampledTransformsGiveANonNegativeCost(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(estimateConversionCost, "rewriteAvailableJSFiles", slowTransform(0.002))
+    monkeypatch.setattr(estimateConversionCost, "formatPYFiles", slowTransform(0.001))
+    estimator = estimateConversionCost.CostEstimator(buildHistory(tmp_path / "repo"))
+    estimator.analyze()
+
+    jsTimings, pyTimings = estimator.timeSampleTransforms(4)
+
+    # spread over the payload sizes, smallest and largest included
+    assert [size for size, _ in jsTimings] == [1000, 3000, 4000, 6000]
+    assert [size for size, _ in pyTimings] == [6, 6, 6]
+    for timings in (jsTimings, pyTimings):
+        overhead, secondsPerByte = estimateConversionCost.fitTimeModel(timings)
+        assert overhead >= 0 and secondsPerByte >= 0
+        assert all(estimateConversionCost.projectedTime((overhead, secondsPerByte), size) > 0 for size, _ in timings)
+
+    estimateConversionCost.printReport(estimator, jsTimings, pyTimings)
+    report = capsys.readouterr().out
+    assert "Peak JS payload:" in report
+    assert "Peak PY payload:" in report
+
+
+def test_reportWithoutPYFiles(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(estimateConversionCost, "rewriteAvailableJSFiles", slowTransform(0.001))
+    estimator = estimateConversionCost.CostEstimator(buildHistory(tmp_path / "repo", withPY=False))
+    estimator.analyze()
+
+    jsTimings, pyTimings = estimator.timeSampleTransforms(3)
+    assert len(jsTimings) == 3
+    assert pyTimings == []
+
+    estimateConversionCost.printReport(estimator, jsTimings, pyTimings)
+    report = capsys.readouterr().out
+    assert "Peak JS payload:" in report
+    assert "Peak PY payload" not in report
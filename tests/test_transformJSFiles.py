@@ -0,0 +1,72 @@
+import json
+from pathlib import Path
+
+import pytest
+
+import transformJSFiles
+from repoFilterUtils import update
+
+FIXTURES_PATH = Path(__file__).resolve().parent / "fixtures" / "jsFixups"
+# What the codemods add to files whose require calls they convert
+REQUIRE_IMPORT = 'import require from "require";'
+
+
+def fakeTransform(jsFilesList):
+    return [update(fileEntry, {"source" : REQUIRE_IMPORT + fileEntry["source"]}) for fileEntry in jsFilesList]
+
+
+@pytest.mark.parametrize("fixturePath", sorted(FIXTURES_PATH.glob("*.json")), ids=lambda path: path.stem)
+def test_fixups(fixturePath):
+    """
+    Each fixture holds a commit's files, the files sent to the transform and the final files, as produced by the
+    original list-pass fixups
+    """
+    fixture = json.loads(fixturePath.read_text(encoding="utf-8"))
+    jsFilesList = [update(fileEntry, {"source" : fileEntry["source"].encode("utf-8")}) for fileEntry in fixture["files"]]
+
+    skippedList, filesToTransform = transformJSFiles.prepareJSFilesForTransform(jsFilesList)
+    assert filesToTransform == fixture["sent"]
+
+    results = transformJSFiles.finishTransformedJSFiles(skippedList, fakeTransform(filesToTransform)) if filesToTransform else []
+    assert results == fixture["output"]
+
+
+def test_splitIntoSizedBatches():
+    batches = transformJSFiles.splitIntoSizedBatches([3, 4, 2, 12, 1, 1, 1], lambda size: size, 9, maxItems=2)
+
+    assert batches == [([3, 4], 7), ([2], 2), ([12], 12), ([1, 1], 2), ([1], 1)]
+
+
+def test_transformRequestsAreBoundedByEncodedBytes(monkeypatch):
+    requests = []
+
+    def recordingTransform(commitId, jsFilesList, metrics = None):
+        requests.append([(fileEntry["commitId"], transformJSFiles.sourceByteCount(fileEntry)) for fileEntry in jsFilesList])
+        return [dict(fileEntry) for fileEntry in jsFilesList]
+
+    monkeypatch.setattr(transformJSFiles, "transformJSFiles", recordingTransform)
+
+    # 8 characters, 16 bytes each
+    twoByteSource = "é" * 8
+    commits = {
+        "small" : [{"name" : "App1/src/small.js", "source" : b"a" * 8}],
+        "large" : [{"name" : "App1/src/large{0}.js".format(number), "source" : twoByteSource.encode("utf-8")}
+                   for number in range(3)],
+        "huge" : [{"name" : "App1/src/huge.js", "source" : b"h" * 40}],
+    }
+
+    client = transformJSFiles.AsyncJSTransformClient(batchBytes=32, batchLatency=0.01)
+    try:
+        futures = {commitId : client.submit(commitId, jsFilesList) for commitId, jsFilesList in commits.items()}
+        results = {commitId : [future.result(timeout=10) for future in fileFutures] for commitId, fileFutures in futures.items()}
+    finally:
+        client.close()
+
+    for commitId, jsFilesList in commits.items():
+        assert [fileEntry["name"] for fileEntry in results[commitId]] == [fileEntry["name"] for fileEntry in jsFilesList]
+        assert all("commitId" not in fileEntry for fileEntry in results[commitId])
+    for request in requests:
+        assert len(request) == 1 or sum(size for _, size in request) <= 32
+    # The large commit alone is over the limit, its files went out in more than one request
+    assert sum(1 for request in requests if any(commitId == "large" for commitId, _ in request)) > 1
+    assert [("huge", 40)] in requests
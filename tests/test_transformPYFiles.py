@@ -0,0 +1,15 @@
+import transformPYFiles
+
+
+def test_formatsPythonSources():
+    [fileEntry] = transformPYFiles.formatPYFiles([{"name" : "PythonService1/a.py", "source" : b"x=[1,2]\n"}])
+
+    assert fileEntry["source"] == "x = [1, 2]\n"
+    assert not fileEntry.get("failed")
+
+
+def test_invalidSourcesAreFlaggedAndKept():
+    [fileEntry] = transformPYFiles.formatPYFiles([{"name" : "PythonService1/a.py", "source" : b"def f(:\n"}])
+
+    assert fileEntry["source"] == "def f(:\n"
+    assert fileEntry["failed"]
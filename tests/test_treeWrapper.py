@@ -0,0 +1,181 @@
+import random
+
+import pygit2
+import pytest
+
+from pylter_branch.TreeProcessor import TreeWrapper
+from historyBuilder import HistoryBuilder
+
+
+BASE_FILES = {
+    "README" : b"readme\n",
+    "src/main.js" : b"main\n",
+    "src/lib/util.js" : b"util\n",
+    "src/lib/deep/nested/leaf.js" : b"leaf\n",
+    "src/other/only.js" : b"only\n",
+    "docs/guide.txt" : b"guide\n",
+}
+
+
+@pytest.fixture
+def repoAndTree(tmp_path):
+    builder = HistoryBuilder(tmp_path / "repo")
+    return builder, builder.repo[builder.tree(BASE_FILES)]
+
+
+def blobEntry(builder, contents):
+    # A tree entry, like the ones the rewrite inserts
+    return builder.repo[builder.tree({"blob" : contents})]["blob"]
+
+
+def applyPerPath(repo, tree, operations):
+    wrapper = TreeWrapper(repo, tree)
+    for op, path, entry in operations:
+        if op == "insert":
+            wrapper.insert(path, entry)
+        elif op == "rm":
+            wrapper.rm(path)
+        else:
+            wrapper.mv(path, entry)
+    return wrapper.hex()
+
+def applyBatch(repo, tree, operations):
+    wrapper = TreeWrapper(repo, tree)
+    wrapper.apply(operations)
+    return wrapper.hex()
+
+
+def treeFiles(repo, treeHex):
+    files = {}
+    def walk(tree, prefix):
+        for entry in tree:
+            if entry.type == pygit2.GIT_OBJ_TREE:
+                walk(repo[entry.id], prefix + entry.name + "/")
+            else:
+                files[prefix + entry.name] = repo[entry.id].data
+    walk(repo[treeHex], "")
+    return files
+
+
+def test_untouchedTreeKeepsItsId(repoAndTree):
+    builder, tree = repoAndTree
+    wrapper = TreeWrapper(builder.repo, tree)
+    wrapper.get("src/lib/deep/nested/leaf.js")
+
+    assert not wrapper.is_dirty()
+    assert wrapper.hex() == tree.hex
+
+
+def test_nestedOperations(repoAndTree):
+    builder, tree = repoAndTree
+    operations = [
+        ("insert", "src/lib/deep/nested/leaf.js", blobEntry(builder, b"leaf, changed\n")),
+        ("insert", "src/new/dir/added.js", blobEntry(builder, b"added\n")),
+        ("rm", "src/other/only.js", None),
+        ("rm", "src/missing/file.js", None),
+        ("rm", "docs/guide.txt", None),
+        ("insert", "docs/guide.txt/now-a-directory.txt", blobEntry(builder, b"directory\n")),
+        ("insert", "README", blobEntry(builder, b"readme, changed\n")),
+    ]
+
+    batchHex = applyBatch(builder.repo, tree, operations)
+    assert batchHex == applyPerPath(builder.repo, tree, operations)
+    assert treeFiles(builder.repo, batchHex) == {
+        "README" : b"readme, changed\n",
+        "src/main.js" : b"main\n",
+        "src/lib/util.js" : b"util\n",
+        "src/lib/deep/nested/leaf.js" : b"leaf, changed\n",
+        "src/new/dir/added.js" : b"added\n",
+        "docs/guide.txt/now-a-directory.txt" : b"directory\n",
+    }
+
+
+def test_untouchedSubtreesKeepTheirIds(repoAndTree):
+    builder, tree = repoAndTree
+    repo = builder.repo
+    newHex = applyPerPath(repo, tree, [("insert", "src/lib/util.js", blobEntry(builder, b"util, changed\n"))])
+    newTree = repo[newHex]
+
+    assert newTree["docs"].id == tree["docs"].id
+    assert newTree["src/other"].id == tree["src/other"].id
+    assert newTree["src/lib/deep"].id == tree["src/lib/deep"].id
+    assert newTree["src/main.js"].id == tree["src/main.js"].id
+    assert newTree["src/lib"].id != tree["src/lib"].id
+    assert newTree["src"].id != tree["src"].id
+
+
+def test_moves(repoAndTree):
+    builder, tree = repoAndTree
+    operations = [
+        ("insert", "src/lib/extra.js", blobEntry(builder, b"extra\n")),
+        ("mv", "src/lib", "lib"),
+        ("mv", "src/main.js", "src/app/main.js"),
+        ("rm", "lib/deep/nested/leaf.js", None),
+        ("insert", "src/app/second.js", blobEntry(builder, b"second\n")),
+    ]
+
+    batchHex = applyBatch(builder.repo, tree, operations)
+    assert batchHex == applyPerPath(builder.repo, tree, operations)
+    assert treeFiles(builder.repo, batchHex) == {
+        "README" : b"readme\n",
+        "lib/util.js" : b"util\n",
+        "lib/extra.js" : b"extra\n",
+        "src/app/main.js" : b"main\n",
+        "src/app/second.js" : b"second\n",
+        "src/other/only.js" : b"only\n",
+        "docs/guide.txt" : b"guide\n",
+    }
+
+
+def test_removingEveryFileRemovesTheDirectories(repoAndTree):
+    builder, tree = repoAndTree
+    operations = [("rm", path, None) for path in BASE_FILES if path.startswith("src/")]
+
+    batchHex = applyBatch(builder.repo, tree, operations)
+    assert batchHex == applyPerPath(builder.repo, tree, operations)
+    assert set(treeFiles(builder.repo, batchHex)) == {"README", "docs/guide.txt"}
+
+
+def test_pathThroughAFileRaises(repoAndTree):
+    builder, tree = repoAndTree
+    for operations in ([("insert", "README/inside", blobEntry(builder, b"x"))], [("rm", "src/main.js/inside", None)]):
+        with pytest.raises(RuntimeError):
+            applyPerPath(builder.repo, tree, operations)
+        with pytest.raises(RuntimeError):
+            applyBatch(builder.repo, tree, operations)
+
+
+def test_unknownOperationRaises(repoAndTree):
+    builder, tree = repoAndTree
+    with pytest.raises(ValueError):
+        TreeWrapper(builder.repo, tree).apply([("copy", "README", "README2")])
+
+
+def test_randomOperationsMatchPerPath(repoAndTree):
+    builder, tree = repoAndTree
+    names = ["a", "b", "c"]
+    randomGenerator = random.Random(7)
+    entries = [blobEntry(builder, str(number).encode()) for number in range(12)]
+
+    def randomPath():
+        return "/".join(randomGenerator.choice(names) for _ in range(randomGenerator.randint(1, 3)))
+
+    for _ in range(300):
+        operations = []
+        for number in range(randomGenerator.randint(1, 12)):
+            kind = randomGenerator.random()
+            if kind < 0.6:
+                operations.append(("insert", randomPath(), entries[number]))
+            elif kind < 0.9:
+                operations.append(("rm", randomPath(), None))
+            else:
+                operations.append(("mv", randomPath(), randomPath()))
+
+        try:
+            expectedHex = applyPerPath(builder.repo, tree, operations)
+        except RuntimeError:
+            # Paths through files raise in both, though not necessarily at the same operation
+            with pytest.raises(RuntimeError):
+                applyBatch(builder.repo, tree, operations)
+            continue
+        assert applyBatch(builder.repo, tree, operations) == expectedHex
@@ -0,0 +1,93 @@
+import sqlite3
+import threading
+import zlib
+
+import pygit2
+
+
+class TransformCache:
+    """
+    Persistent, content-addressed cache of transform results, shared by every run:
+        (source blob ID, path class, transformer fingerprint) -> result blob ID
+    The result contents are stored alongside, so hits can be written into a freshly cloned output repo.
+    Results of older transformer versions never match the current fingerprint and are pruned on open.
+    """
+
+    def __init__(self, cachePath, currentFingerprints = ()):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(cachePath), check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (sourceId TEXT, pathClass TEXT, fingerprint TEXT, resultId TEXT, "
+            "PRIMARY KEY (sourceId, pathClass, fingerprint))"
+        )
+        self._connection.execute("CREATE TABLE IF NOT EXISTS blobs (id TEXT PRIMARY KEY, data BLOB)")
+
+        self.hits = 0
+        self.misses = 0
+
+        if currentFingerprints:
+            self.pruneStaleResults(currentFingerprints)
+
+    def get(self, sourceId, pathClass, fingerprint):
+        """
+        Returns the cached result contents as bytes, or None
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT blobs.data FROM results JOIN blobs ON blobs.id = results.resultId "
+                "WHERE results.sourceId = ? AND results.pathClass = ? AND results.fingerprint = ?",
+                (str(sourceId), pathClass, fingerprint)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return zlib.decompress(row[0])
+
+    def contains(self, sourceId, pathClass, fingerprint):
+        """
+        Whether a result is cached, without reading it or counting a hit or miss
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM results WHERE sourceId = ? AND pathClass = ? AND fingerprint = ?",
+                (str(sourceId), pathClass, fingerprint)
+            ).fetchone()
+        return row is not None
+
+    def put(self, sourceId, pathClass, fingerprint, resultSource):
+        if isinstance(resultSource, str):
+            resultSource = resultSource.encode("utf-8")
+        resultId = pygit2.hash(resultSource).hex
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO blobs (id, data) VALUES (?, ?)", (resultId, zlib.compress(resultSource))
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (sourceId, pathClass, fingerprint, resultId) VALUES (?, ?, ?, ?)",
+                (str(sourceId), pathClass, fingerprint, resultId)
+            )
+
+        return resultId
+
+    def pruneStaleResults(self, currentFingerprints):
+        placeholders = ", ".join("?" * len(currentFingerprints))
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM results WHERE fingerprint NOT IN ({0})".format(placeholders), tuple(currentFingerprints)
+            )
+            self._connection.execute("DELETE FROM blobs WHERE id NOT IN (SELECT resultId FROM results)")
+
+    def statsMessage(self):
+        lookups = self.hits + self.misses
+        hitRate = 100.0 * self.hits / lookups if lookups else 0.0
+        return "Transform cache: {0} hits, {1} misses ({2: >#0.1f}% hit rate)".format(self.hits, self.misses, hitRate)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
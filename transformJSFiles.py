@@ -1,5 +1,12 @@
 import re
 import sys, os
+import glob
+from collections import namedtuple
+from functools import lru_cache
+import gzip, json
+import threading, time
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 import shutil, tempfile
 from unicodedata import normalize
@@ -11,10 +18,30 @@ import requests
 from plumbum import local
 
 
-from repoFilterUtils import update, replaceEntry, normalizeEntry
+import repoFilterUtils
+from repoFilterUtils import update, normalizeEntry, fingerprintFiles
+from runMetrics import CommitMetrics, timedStage
 
 FILES_TO_SKIP = ["someSpecificFile.js"]
 
+JS_CODEMODS_PATH = Path(__file__).resolve().parent / "js-codemods"
+
+JS_TRANSFORM_SERVER_URL = "http://localhost:4444"
+# gzip the request bodies (the server gzips its responses in turn); level 1 already shrinks JS sources several times
+COMPRESS_TRANSFORM_REQUESTS = True
+REQUEST_COMPRESSION_LEVEL = 1
+# The server leaves the half-transformed source of failed files out of its response unless asked for
+INCLUDE_FAILED_SOURCE = False
+# Requests AsyncJSTransformClient keeps in flight at once; the server spreads their files over its worker pool
+JS_MAX_IN_FLIGHT_REQUESTS = 8
+# AsyncJSTransformClient coalesces the files of consecutive commits into one request until they add up to this many
+# bytes of source, well under the server's 50 MB JSON limit once escaped, or until the oldest one waited this long
+JS_BATCH_MAX_BYTES = 16 * 2**20
+JS_BATCH_MAX_LATENCY = 0.05
+
+DYNAMIC_IMPORTS_FILE = "entryPoint.js"
+REQUIRE_IMPORT_FILES = ["entryPoint.js", "largeChunk.js", "smallChunk.js"]
+
 
 SYNTAX_FIXES = {
     "App1/src/file1.js" : [
@@ -33,12 +60,6 @@ SYNTAX_FIXES = {
 
 
 
-def find(f, seq):
-  """Return first item in sequence where f(item) == True."""
-  for item in seq:
-    if f(item):
-      return item
-
 def findFileByName(fileName):
     def findCallback(fileEntry):
         path = Path(fileEntry["name"])
@@ -47,124 +68,393 @@ def findFileByName(fileName):
     return findCallback
 
 
+def isSkippedFile(fileName):
+    return any([fileName.endswith(fileToSkip) for fileToSkip in FILES_TO_SKIP])
+
+def isFormatOnlyFile(fileName):
+    return fileName.startswith("App2")
+
+def isFirstMatchDependent(fileName):
+    """
+    Whether a first-match fixup may apply to this file, depending on the other files transformed along with it
+    """
+    rules = jsPathRules(fileName)
+    return rules.dynamicImports or bool(rules.requireImportNames)
+
+
+# Everything the fixups around the transform decide from a file's path alone:
+#   skip:               left out of the transform (FILES_TO_SKIP)
+#   formatOnly:         only formatted, not transformed
+#   dynamicImports:     named like DYNAMIC_IMPORTS_FILE; the first such file of a commit gets its dynamic imports
+#                       swapped around the transform
+#   requireImportNames: the REQUIRE_IMPORT_FILES names it matches, in list order; the first file of a commit matching
+#                       a name gets the converted require import removed
+#   syntaxFixes:        the SYNTAX_FIXES lists of (search, replace) that apply to it, in dict order
+JSPathRules = namedtuple("JSPathRules", ["skip", "formatOnly", "dynamicImports", "requireImportNames", "syntaxFixes"])
+
+@lru_cache(maxsize=None)
+def jsPathRules(fileName):
+    fileEntry = {"name" : fileName}
+    return JSPathRules(
+        skip=isSkippedFile(fileName),
+        formatOnly=isFormatOnlyFile(fileName),
+        dynamicImports=bool(findFileByName(DYNAMIC_IMPORTS_FILE)(fileEntry)),
+        requireImportNames=tuple(name for name in REQUIRE_IMPORT_FILES if findFileByName(name)(fileEntry)),
+        syntaxFixes=tuple(fixes for badFileName, fixes in SYNTAX_FIXES.items() if fileName.endswith(badFileName)),
+    )
+
+def replaceSource(source, searchText, replaceText):
+    if isinstance(searchText, re.Pattern):
+        return searchText.sub(replaceText, source)
+    return source.replace(searchText, replaceText)
 
 
-def replaceUnicodeCharacters(jsFilesList):
-    return list(map(normalizeEntry, jsFilesList))
-
-def replaceContent(fileEntry, searchText, replaceText):
-    source = fileEntry["source"]
-
-    if isinstance(searchText, re.Pattern):
-        newText = searchText.sub(replaceText, source)
-    else:
-        newText = source.replace(searchText, replaceText)
-    return update(fileEntry, {"source" : newText})
+def jsPathClasses(jsFilesList):
+    """
+    Describes, for each file of a commit, every path-dependent step rewriteAvailableJSFiles applies to it.
+    Two files with the same source and the same class are rewritten to the same result.
 
+    Some fixups only apply to the first file matching a name, so the classes depend on the whole list.
+    """
+    classes = []
+    claimedNames = set()
 
-def replaceDynamicImports(jsFilesList):
-    entryPoint = find(findFileByName("entryPoint.js"), jsFilesList)
+    for fileEntry in jsFilesList:
+        fileName = fileEntry["name"]
+        rules = jsPathRules(fileName)
 
-    newFilesList = jsFilesList
+        if rules.skip:
+            classes.append("skip")
+            continue
 
-    if (entryPoint):
-        newFileEntry = replaceContent(entryPoint, "import(", "require.ensure(")
-        newFilesList = replaceEntry(jsFilesList, entryPoint, newFileEntry)
+        parts = ["formatOnly" if rules.formatOnly else "transform"]
 
-    return newFilesList
+        # The first file named entryPoint.js also gets its dynamic imports swapped around the transform
+        for name in rules.requireImportNames:
+            if name not in claimedNames:
+                claimedNames.add(name)
+                parts.append("first:" + name)
 
-def undoReplaceDynamicImports(jsFilesList):
-    entryPoint = find(findFileByName("entryPoint.js"), jsFilesList)
+        parts.extend(["fix:" + badFileName for badFileName in SYNTAX_FIXES if fileName.endswith(badFileName)])
 
-    newFilesList = jsFilesList
+        classes.append(";".join(parts))
 
-    if (entryPoint):
-        newFileEntry = replaceContent(entryPoint, "require.ensure(", "import(")
-        newFilesList = replaceEntry(jsFilesList, entryPoint, newFileEntry)
+    return classes
 
-    return newFilesList
 
+def jsTransformerFingerprint():
+    """
+    Changes whenever the codemods, their installed dependencies or the Python-side fixups change
+    """
+    codemodFiles = glob.glob(str(JS_CODEMODS_PATH / "*.js")) + glob.glob(str(JS_CODEMODS_PATH / "utils" / "*.js"))
+    dependencyFiles = [JS_CODEMODS_PATH / "package.json", JS_CODEMODS_PATH / "yarn.lock"]
+    dependencyFiles += [JS_CODEMODS_PATH / "node_modules" / package / "package.json" for package in ("jscodeshift", "prettier")]
+    pythonFiles = [__file__, repoFilterUtils.__file__]
 
-def removeConvertedRequireImports(jsFilesList):
-    newFilesList = jsFilesList
-    for filename in ["entryPoint.js", "largeChunk.js", "smallChunk.js"]:
-        fileEntry = find(findFileByName(filename), newFilesList)
+    return fingerprintFiles(codemodFiles + dependencyFiles + pythonFiles)
 
-        if(fileEntry):
-            newFileEntry = replaceContent(fileEntry, 'import require from "require";', "")
-            newFilesList = replaceEntry(newFilesList, fileEntry, newFileEntry)
 
-    return newFilesList
+localSessions = threading.local()
 
+def transformServerSession():
+    """
+    Keep-alive session to the transform server, one per thread since requests.Session is not thread-safe
+    """
+    session = getattr(localSessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        localSessions.session = session
+    return session
 
 
-def fixInvalidSyntax(jsFilesList):
-    fileFixes = SYNTAX_FIXES.items()
+def expandTransformResult(fileEntry, result):
+    """
+    Merges a compact server result back into the file entry it was sent as: unchanged files come back without
+    a source, failed ones with a failed flag
+    """
+    transformedEntry = dict(fileEntry)
+    if "source" in result:
+        transformedEntry["source"] = result["source"]
+    if result.get("failed"):
+        transformedEntry["failed"] = True
+        if "failedSource" in result:
+            transformedEntry["failedSource"] = result["failedSource"]
+    return transformedEntry
 
-    newFilesList = jsFilesList
 
+def transformJSFiles(commitId, jsFilesList, metrics = None):
     for fileEntry in jsFilesList:
-        fileName = fileEntry["name"]
 
-        for badFileName, fixes in fileFixes:
-            if fileName.endswith(badFileName):
-                newFileEntry = fileEntry
-                for searchText, replaceText in fixes:
-                    newFileEntry = replaceContent(newFileEntry, searchText, replaceText)
-                newFilesList = replaceEntry(newFilesList, fileEntry, newFileEntry)
+        fileSource = fileEntry["source"]
+        isApp2SourceFile = isFormatOnlyFile(fileEntry["name"])
 
+        fileEntry["formatOnly"] = isApp2SourceFile
 
-    return newFilesList
+    startTime = time.perf_counter()
 
-def filterFilesToBeSkipped(jsFilesList):
-    skippedList = []
-    newJsFilesList = []
+    request = {"commitId" : commitId, "files" : jsFilesList, "compact" : True, "includeFailedSource" : INCLUDE_FAILED_SOURCE}
+    body = json.dumps(request, ensure_ascii=False).encode("utf-8")
+    headers = {"Content-Type" : "application/json"}
+    if COMPRESS_TRANSFORM_REQUESTS:
+        body = gzip.compress(body, REQUEST_COMPRESSION_LEVEL)
+        headers["Content-Encoding"] = "gzip"
 
-    for fileEntry in jsFilesList:
-        fileName = fileEntry["name"]
+    # requests asks for and decodes gzip responses by itself
+    response = transformServerSession().post(JS_TRANSFORM_SERVER_URL, data=body, headers=headers)
+    response.raise_for_status()
+    results = response.json()
 
-        shouldSkip = any([fileName.endswith(fileToSkip) for fileToSkip in FILES_TO_SKIP])
+    transformedFiles = [expandTransformResult(fileEntry, result) for fileEntry, result in zip(jsFilesList, results)]
 
+    if metrics is not None:
+        # Whatever the server did not spend transforming is transport: encoding, compression, the round trip, decoding
+        elapsedTime = time.perf_counter() - startTime
+        serverTime = min(float(response.headers.get("X-Transform-Seconds", 0)), elapsedTime)
+        metrics.stageTimes["jsTransform"] += serverTime
+        metrics.stageTimes["jsTransport"] += elapsedTime - serverTime
+        metrics.count("jsRequestBytes", len(body))
+        metrics.count("jsResponseBytes", int(response.headers.get("Content-Length", len(response.content))))
+
+    return transformedFiles
 
-        if shouldSkip:
-            skippedList.append(fileEntry)
-        else:
-            newJsFilesList.append(fileEntry)
 
-    return (skippedList, newJsFilesList)
+def prepareJSFilesForTransform(jsFilesList):
+    """
+    The fixups of a commit's files before the transform, in one pass over the files
+    :return: (skipped files, files to transform)
+    """
+    skippedList = []
+    filesToTransform = []
+    dynamicImportsClaimed = False
 
+    for fileEntry in jsFilesList:
+        rules = jsPathRules(fileEntry["name"])
+        # The only copy made of each entry
+        fileEntry = normalizeEntry(fileEntry)
 
+        if rules.skip:
+            skippedList.append(fileEntry)
+            continue
+
+        source = fileEntry["source"]
+        if rules.dynamicImports and not dynamicImportsClaimed:
+            dynamicImportsClaimed = True
+            source = source.replace("import(", "require.ensure(")
+
+        # If several SYNTAX_FIXES names match, only the first one that changes the file applies
+        for fixes in rules.syntaxFixes:
+            fixedSource = source
+            for searchText, replaceText in fixes:
+                fixedSource = replaceSource(fixedSource, searchText, replaceText)
+            if fixedSource != source:
+                source = fixedSource
+                break
+
+        fileEntry["source"] = source
+        filesToTransform.append(fileEntry)
+
+    return (skippedList, filesToTransform)
+
+def finishTransformedJSFiles(skippedList, jsFilesList):
+    """
+    The fixups of a commit's files after the transform, in one pass over the files
+    """
+    totalResults = list(skippedList)
+    claimedNames = set()
+    dynamicImportsClaimed = False
 
-def transformJSFiles(commitId, jsFilesList):
     for fileEntry in jsFilesList:
+        rules = jsPathRules(fileEntry["name"])
+        source = fileEntry["source"]
 
-        fileSource = fileEntry["source"]
-        isApp2SourceFile = fileEntry["name"].startswith("App2")
+        for name in rules.requireImportNames:
+            if name not in claimedNames:
+                claimedNames.add(name)
+                source = source.replace('import require from "require";', "")
 
-        fileEntry["formatOnly"] = isApp2SourceFile
+        if rules.dynamicImports and not dynamicImportsClaimed:
+            dynamicImportsClaimed = True
+            source = source.replace("require.ensure(", "import(")
 
-    request = {"commitId" : commitId, "files" : jsFilesList}
-    response = requests.post("http://localhost:4444", json=request)
-    transformedFiles = response.json()
-    return transformedFiles
+        # Only the few first-match files get copied
+        totalResults.append(fileEntry if source is fileEntry["source"] else update(fileEntry, {"source" : source}))
+
+    return totalResults
 
 
-def rewriteAvailableJSFiles(commitId, jsFilesList):
-    jsFilesList = replaceUnicodeCharacters(jsFilesList)
-    skippedList, jsFilesList = filterFilesToBeSkipped(jsFilesList)
+def sourceByteCount(fileEntry):
+    """
+    Size of a file's source once UTF-8 encoded, as it is sent to the transform server
+    """
+    source = fileEntry["source"]
+    return len(source) if isinstance(source, bytes) else len(source.encode("utf-8"))
+
+def splitIntoSizedBatches(items, sizeOf, maxBytes, maxItems = None):
+    """
+    Splits items into consecutive batches of at most `maxBytes` according to `sizeOf`, and of at most `maxItems` items.
+    An item larger than `maxBytes` makes a batch of its own.
+    :return: list of (batch, its size in bytes)
+    """
+    batches = []
+    batch = []
+    batchBytes = 0
+    for item in items:
+        itemBytes = sizeOf(item)
+        if batch and (batchBytes + itemBytes > maxBytes or len(batch) == maxItems):
+            batches.append((batch, batchBytes))
+            batch = []
+            batchBytes = 0
+        batch.append(item)
+        batchBytes += itemBytes
+    if batch:
+        batches.append((batch, batchBytes))
+    return batches
+
+
+def rewriteAvailableJSFiles(commitId, jsFilesList, metrics = None):
+    with timedStage(metrics, "jsFixups"):
+        skippedList, jsFilesList = prepareJSFilesForTransform(jsFilesList)
 
     if not jsFilesList:
         return []
 
-
-    jsFilesList = replaceDynamicImports(jsFilesList)
-    jsFilesList = fixInvalidSyntax(jsFilesList)
-    jsFilesList = transformJSFiles(commitId, jsFilesList)
-    jsFilesList = removeConvertedRequireImports(jsFilesList)
-    jsFilesList = undoReplaceDynamicImports(jsFilesList)
-
-    totalResults = skippedList + jsFilesList
-    return totalResults
+    jsFilesList = transformJSFiles(commitId, jsFilesList, metrics)
+
+    with timedStage(metrics, "jsFixups"):
+        return finishTransformedJSFiles(skippedList, jsFilesList)
+
+
+class AsyncJSTransformClient:
+    """
+    Does what rewriteAvailableJSFiles does for several commits at once, so the server's worker pool stays busy even
+    when each commit only changes a file or two.
+
+    The event loop runs on its own thread. Coroutines can await rewriteFiles on that loop, and any other thread can
+    submit a commit's files and get a future per file. The files of consecutive commits are coalesced into one request
+    of up to `batchBytes` bytes of source, sent at the latest `batchLatency` seconds after its first commit came in;
+    the files of a larger commit are spread over several requests.
+    Every file carries its own commit ID, and the results are split back per commit for the per-commit fixups.
+    At most `maxInFlight` requests are in flight at any time; each of them goes through the blocking keep-alive
+    transport on one of `maxInFlight` threads.
+    """
+
+    def __init__(self, maxInFlight = JS_MAX_IN_FLIGHT_REQUESTS, batchBytes = JS_BATCH_MAX_BYTES,
+                 batchLatency = JS_BATCH_MAX_LATENCY):
+        self._loop = asyncio.new_event_loop()
+        self._maxInFlight = maxInFlight
+        self._batchBytes = batchBytes
+        self._batchLatency = batchLatency
+        self._executor = ThreadPoolExecutor(max_workers=maxInFlight)
+        # Created on the loop's thread, older asyncio versions bind it to the current loop
+        self._inFlight = None
+
+        # (commit ID, files, metrics, future) of the commits, or parts of commits, waiting for the next request
+        self._batchJobs = []
+        self._batchSize = 0
+        self._flushHandle = None
+
+        self._thread = threading.Thread(target=self._loop.run_forever, name="js-transform-client", daemon=True)
+        self._thread.start()
+
+    async def rewriteFiles(self, commitId, jsFilesList, metrics = None):
+        with timedStage(metrics, "jsFixups"):
+            skippedList, jsFilesList = prepareJSFilesForTransform(jsFilesList)
+
+        if not jsFilesList:
+            return []
+
+        jobFutures = []
+        for jobFiles, jobSize in splitIntoSizedBatches(jsFilesList, sourceByteCount, self._batchBytes):
+            jobFuture = self._loop.create_future()
+            self._addToBatch((commitId, jobFiles, metrics, jobFuture), jobSize)
+            jobFutures.append(jobFuture)
+        jsFilesList = [fileEntry for jobFiles in await asyncio.gather(*jobFutures) for fileEntry in jobFiles]
+
+        with timedStage(metrics, "jsFixups"):
+            return finishTransformedJSFiles(skippedList, jsFilesList)
+
+    def _addToBatch(self, job, jobSize):
+        if self._batchJobs and self._batchSize + jobSize > self._batchBytes:
+            self._flushBatch()
+
+        self._batchJobs.append(job)
+        self._batchSize += jobSize
+
+        if self._batchSize >= self._batchBytes:
+            self._flushBatch()
+        elif self._flushHandle is None:
+            self._flushHandle = self._loop.call_later(self._batchLatency, self._flushBatch)
+
+    def _flushBatch(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+
+        jobs = self._batchJobs
+        self._batchJobs = []
+        self._batchSize = 0
+        if jobs:
+            self._loop.create_task(self._sendBatch(jobs))
+
+    async def _sendBatch(self, jobs):
+        if self._inFlight is None:
+            self._inFlight = asyncio.Semaphore(self._maxInFlight)
+
+        batchFiles = [update(fileEntry, {"commitId" : commitId}) for commitId, jsFilesList, _, _ in jobs for fileEntry in jsFilesList]
+        batchMetrics = CommitMetrics(jobs[0][0])
+
+        async with self._inFlight:
+            try:
+                transformedFiles = await self._loop.run_in_executor(
+                    self._executor, transformJSFiles, jobs[0][0], batchFiles, batchMetrics
+                )
+            except Exception as e:
+                for _, _, _, jobFuture in jobs:
+                    jobFuture.set_exception(e)
+                return
+
+        start = 0
+        for commitId, jsFilesList, metrics, jobFuture in jobs:
+            commitFiles = transformedFiles[start:start + len(jsFilesList)]
+            start += len(jsFilesList)
+
+            for fileEntry in commitFiles:
+                del fileEntry["commitId"]
+            if metrics is not None:
+                # The commits of a request share its transport and transform time by their number of files
+                metrics.addShare(batchMetrics, len(jsFilesList) / len(batchFiles))
+            jobFuture.set_result(commitFiles)
+
+    def submit(self, commitId, jsFilesList, metrics = None):
+        """
+        Queues a commit's files for rewriting, from any thread.
+        :return: a concurrent.futures.Future per file, in jsFilesList order. It resolves to the rewritten entry,
+                 or to None if rewriteAvailableJSFiles left the file out (skipped files, when nothing else is left)
+        """
+        fileNames = [fileEntry["name"] for fileEntry in jsFilesList]
+        fileFutures = [Future() for _ in fileNames]
+
+        def distributeResults(requestFuture):
+            try:
+                rewrittenEntries = requestFuture.result()
+            except BaseException as e:
+                for fileFuture in fileFutures:
+                    fileFuture.set_exception(e)
+                return
+
+            entriesByName = {fileEntry["name"] : fileEntry for fileEntry in rewrittenEntries}
+            for fileName, fileFuture in zip(fileNames, fileFutures):
+                fileFuture.set_result(entriesByName.get(fileName))
+
+        requestFuture = asyncio.run_coroutine_threadsafe(self.rewriteFiles(commitId, jsFilesList, metrics), self._loop)
+        requestFuture.add_done_callback(distributeResults)
+        return fileFutures
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        self._loop.close()
 
 
 def main():
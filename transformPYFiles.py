@@ -1,23 +1,33 @@
 from unicodedata import normalize
 
+import black
 from black import format_str, InvalidInput
-from repoFilterUtils import update, normalizeEntry
+import repoFilterUtils
+from repoFilterUtils import update, normalizeEntry, fingerprintFiles
+
+LINE_LENGTH = 120
 
 
 
 def formatSource(sourceText):
-    formattedSource = sourceText
-    try:
-        formattedSource = format_str(sourceText, 120)
-    except Exception as e:
-        print(e)
-    return formattedSource
+    return format_str(sourceText, mode=black.Mode(line_length=LINE_LENGTH))
 
 def formatFileEntry(fileEntry):
     normalizedEntry = normalizeEntry(fileEntry)
-    formattedSource = formatSource(normalizedEntry["source"])
+    try:
+        formattedSource = formatSource(normalizedEntry["source"])
+    except Exception as e:
+        print(e)
+        # Kept unformatted, and flagged like failed JS transforms so the result is not cached
+        return update(fileEntry, {"source" : normalizedEntry["source"], "failed" : True})
     return update(fileEntry, {"source" : formattedSource})
 
 def formatPYFiles(filesList):
     formattedFiles = list(map(formatFileEntry, filesList))
-    return formattedFiles
\ No newline at end of file
+    return formattedFiles
+
+def pyTransformerFingerprint():
+    """
+    Changes whenever Black or the formatting settings change
+    """
+    return fingerprintFiles([__file__, repoFilterUtils.__file__], black.__version__, LINE_LENGTH)